@@ -9,10 +9,18 @@
 The 'Query' class provides raw access to the Archive's database.
 
 The LMA data from the Archive is cached locally, and accessed through
-the 'ArtistList' and 'ConcertList' classes. Concert details are
-retrieved with the 'ConcertFileList' and 'ConcertDetails' classes. Songs
-from a specific concert are downloaded with the 'download_files'
-function.
+the 'ArtistList' and 'ConcertList' classes.  The 'ConcertTimeline'
+class lists the concerts of a whole set of artists in date order.
+Concert details are retrieved with the 'ConcertFileList' and
+'ConcertDetails' classes, and the 'Prefetcher' class fetches them in
+the background, ahead of need.  Everything cached can be searched
+with the 'search_details' and 'search_tracks' functions. Songs from a
+specific concert are downloaded with the 'download_files' function,
+or queued for the 'DownloadManager' to download in the background.
+A 'ContentStore' keeps one copy of songs shared by several concerts,
+and a 'Pipeline' processes songs (converting them, say) as they arrive.
+The 'scan_library' function finds the songs already downloaded, and
+'scrub_library' checks them against the Archive's checksums.
 
 The database module provides common base classes for the 'Artist',
 'Concert', 'ArtistList', and 'ConcertList' classes.
@@ -33,8 +41,25 @@ from lma.database import (ArDb, DbList, DbRecord)
 
 from lma.artist import (ArtistList, Artist, AVIEW_SELECTORS)
 
-from lma.concert import (ConcertList, Concert, CVIEW_SELECTORS)
+from lma.concert import (ConcertList, Concert, CVIEW_SELECTORS,
+                         ConcertTimeline, TVIEW_SELECTORS)
 
-from lma.details import (ConcertDetails, ConcertFileList, default_formats)
+from lma.details import (ConcertDetails, ConcertFileList, default_formats,
+                         meta_fields, store_details)
 
 from lma.download import (download_files)
+
+from lma.library import (is_verified, record_verified, scan_library,
+                         scrub_library, requeue_damaged)
+
+from lma.store import (ContentStore, STORE_DIR)
+
+from lma.postprocess import (Pipeline, PROCESSORS, configured_processors,
+                             PP_QUEUED, PP_ACTIVE, PP_DONE, PP_FAILED)
+
+from lma.dlmanager import (DownloadManager, DL_QUEUED, DL_ACTIVE, DL_PAUSED,
+                           DL_DONE, DL_FAILED)
+
+from lma.prefetch import (Prefetcher, harvest_details)
+
+from lma.search import (search_details, search_tracks)
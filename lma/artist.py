@@ -80,28 +80,46 @@ class ArtistList(lma.DbList):
     def repopulate(self, progbar = lma.NullProgressBar):
         """Update the DB from the internet, then refresh."""
 
-        # get the last update date
+        # get the last update date, and the newest item we saw then
         lastdate = self.lastUpdate()
+        watermark = self.lastPublished()
 
-        # form the archive query (including lastdate)
+        # form the archive query (only asking for what we haven't seen)
         aquery = lma.Query(lma.BAND_QUERY)
         aquery.add_fields(lma.STANDARD_FIELDS)
         aquery.add_sort(lma.PUBDATE)
-        aquery.newer_than(lastdate)
+        if watermark != None:
+            aquery.published_after(watermark)
+        else:
+            # databases from older versions only have the date
+            aquery.newer_than(lastdate)
 
         # create the progress bar callback
+        # (we get a page of records at a time, so update on every one)
         callback = lma.ProgressCallback("Live Music Archive Download",
-                                        "Retrieve Artists from LMA", progbar)
+                                        "Retrieve Artists from LMA", progbar,
+                                        frequency=1, can_cancel=True)
 
         c = self._db.cursor()
-        # push the records into our database, with callback
-        c.executemany("INSERT OR IGNORE INTO artist (aname, lmaid)"
-                      "  VALUES (:title, :identifier)",
-                       lma.ProgressIter(aquery, callback))
-
-        # now update the last-updated field
-        c.execute("UPDATE lma_config SET last_artist_read = date('now')"
-                   "WHERE recnum = 1")
+        # push the records into our database a page at a time, with callback
+        # (the following pages are fetched in the background meanwhile)
+        pipeline = aquery.pipeline([lma.TITLE, lma.IDENTIFIER],
+                                   watermark=lma.PUBDATE)
+        pages = lma.ProgressIter(pipeline, callback)
+        try:
+            for rows in pages:
+                c.executemany("INSERT OR IGNORE INTO artist (aname, lmaid)"
+                              "  VALUES (?, ?)", rows)
+        finally:
+            # (stops the background readers, if we didn't get to the end)
+            pages.cancel()
+
+        # now update the last-updated field (unless we were interrupted,
+        # in which case we keep what we got, but try again next time)
+        if not pages.cancelled:
+            c.execute("UPDATE lma_config SET last_artist_read = date('now'),"
+                      "  artist_watermark = ? WHERE recnum = 1",
+                      (pipeline.watermark or watermark,))
 
         self._db.commit()
         c.close()
@@ -133,6 +151,14 @@ class ArtistList(lma.DbList):
         c.close()
         return lastdate
 
+    def lastPublished(self):
+        """Return the newest publicdate seen in the last complete update."""
+        c = self._db.cursor()
+        c.execute("SELECT artist_watermark FROM lma_config WHERE recnum = 1")
+        watermark = c.fetchone()[0]
+        c.close()
+        return watermark
+
     # properties for mode selection
     @property
     def mode(self):
@@ -21,6 +21,14 @@ CVIEW_NEW = _(u"New Concerts")
 CVIEW_DL = _(u"Downloaded")
 CVIEW_SELECTORS = [CVIEW_ALL, CVIEW_FAVORITES, CVIEW_NEW, CVIEW_DL]
 
+# selectors for the set of artists covered by a concert timeline
+TVIEW_ALL = _(u"All Artists")
+TVIEW_FAVORITES = _(u"Favorite Artists")
+TVIEW_SELECTORS = [TVIEW_ALL, TVIEW_FAVORITES]
+
+# number of concerts fetched at a time by a timeline
+TIMELINE_PAGE_SIZE = 200
+
 #
 # db wrapper for a concert id
 #
@@ -31,7 +39,7 @@ class Concert(lma.DbRecord):
 
     def fileList(self):
         """Return the songs associated with this concert."""
-        return ConcertFileList(self)
+        return lma.ConcertFileList(self._db, self)
 
     def details(self):
         """Return the details for this concert."""
@@ -45,6 +53,14 @@ class Concert(lma.DbRecord):
         self._db.commit()
         c.close()
 
+    def isVerified(self, path, md5):
+        """Has the downloaded file at path been checked against md5?"""
+        return lma.library.is_verified(self._db, path, md5)
+
+    def recordVerified(self, path, md5):
+        """Record that the downloaded file at path matches its md5."""
+        lma.library.record_verified(self._db, path, md5, int(self))
+
     # properties
     @property
     def name(self):
@@ -113,8 +129,12 @@ class ConcertList(lma.DbList):
         self._data = [x[0] for x in c.fetchall()]
         c.close()
 
-    def repopulate(self, progbar = lma.NullProgressBar):
-        """Update the DB from the internet, then refresh."""
+    def repopulate(self, progbar = lma.NullProgressBar, details=False):
+        """Update the DB from the internet, then refresh.
+
+        If details is set, the concert details (description, notes, etc.)
+        are fetched along with the list and stored in the details cache,
+        saving a download for each concert later."""
 
         c = self._db.cursor()
         c.execute("SELECT lmaid, aname FROM artist"
@@ -122,28 +142,58 @@ class ConcertList(lma.DbList):
         lmaid, aname = c.fetchone()
 
         lastdate = self.lastUpdate()
+        watermark = self.lastPublished()
 
-        # form the archive query (including lastdate)
+        # form the archive query (only asking for what we haven't seen)
         cquery = lma.Query(lma.CONCERT_QUERY(lmaid))
         cquery.add_fields(lma.STANDARD_FIELDS)
         cquery.add_fields([lma.DATE, lma.YEAR])
         cquery.add_sort(lma.PUBDATE)
-        cquery.newer_than(lastdate)
+        if watermark != None:
+            cquery.published_after(watermark)
+        else:
+            # artists browsed by older versions only have the date
+            cquery.newer_than(lastdate)
 
         # create the progress bar callback
+        # (we get a page of records at a time, so update on every one)
         callback = lma.ProgressCallback("Live Music Archive Download",
                                         "Retrieve %s Concert List" % aname,
-                                        progbar)
-
-        # push the records into our database, with callback
-        c.executemany("INSERT OR IGNORE INTO concert"
-                      " (ctitle, lmaid, cyear, cdate, artistid) VALUES"
-                      "  (:title, :identifier, :year, date(:date), %s)" %
-                      str(self._artist), lma.ProgressIter(cquery, callback))
-
-        # now update the artist's last-updated field
-        c.execute("INSERT OR REPLACE INTO lastbrowse (aid, browsedate)"
-                  "  VALUES (?, date('now'))", (str(self._artist),))
+                                        progbar, frequency=1,
+                                        can_cancel=True)
+
+        # push the records into our database a page at a time, with callback
+        # (the following pages are fetched in the background meanwhile)
+        columns = [lma.TITLE, lma.IDENTIFIER, lma.YEAR, lma.DATE]
+        if details:
+            columns += lma.meta_fields
+        pipeline = cquery.pipeline(columns, watermark=lma.PUBDATE)
+        pages = lma.ProgressIter(pipeline, callback)
+        try:
+            for rows in pages:
+                if details:
+                    # details go in after their concerts, from the same page
+                    concerts = [row[:4] for row in rows]
+                else:
+                    concerts = rows
+                c.executemany("INSERT OR IGNORE INTO concert"
+                              " (ctitle, lmaid, cyear, cdate, artistid)"
+                              "  VALUES (?, ?, ?, date(?), %s)" %
+                              str(self._artist), concerts)
+                if details:
+                    lma.store_details(c, [row[1:2] + row[4:]
+                                          for row in rows])
+        finally:
+            # (stops the background readers, if we didn't get to the end)
+            pages.cancel()
+
+        # now update the artist's last-updated field (unless we were
+        # interrupted, in which case we keep what we got, but try again)
+        if not pages.cancelled:
+            c.execute("INSERT OR REPLACE INTO lastbrowse"
+                      "  (aid, browsedate, watermark)"
+                      "  VALUES (?, date('now'), ?)",
+                      (str(self._artist), pipeline.watermark or watermark))
 
         self._db.commit()
         c.close()
@@ -154,6 +204,19 @@ class ConcertList(lma.DbList):
 
         self.refresh()
 
+    def makeOffline(self, progbar = lma.NullProgressBar):
+        """Fetch and cache details and file lists for all our concerts.
+
+        Returns the number of concerts which couldn't be fetched."""
+        c = self._db.cursor()
+        c.execute("SELECT cid FROM concert WHERE artistid = ?"
+                  "  ORDER BY cdate", (str(self._artist),))
+        concerts = [Concert(self._db, x[0]) for x in c.fetchall()]
+        c.close()
+        return lma.harvest_details(self._db, concerts, progbar,
+                                   "Retrieve %s Concert Details" %
+                                   self._aname)
+
     def _clearNew(self):
         """Internal: clear 'new' concerts list, but don't refresh!"""
         c = self._db.cursor()
@@ -182,9 +245,22 @@ class ConcertList(lma.DbList):
         c = self._db.cursor()
         c.execute("SELECT browsedate FROM lastbrowse"
                   "  WHERE aid = ?", (str(self._artist),))
-        lastdate = c.fetchone()[0]
+        row = c.fetchone()
         c.close()
-        return lastdate
+        if row == None:
+            return None
+        return row[0]
+
+    def lastPublished(self):
+        """Return the newest publicdate seen in the last complete update."""
+        c = self._db.cursor()
+        c.execute("SELECT watermark FROM lastbrowse"
+                  "  WHERE aid = ?", (str(self._artist),))
+        row = c.fetchone()
+        c.close()
+        if row == None:
+            return None
+        return row[0]
 
     def forget(self):
         """Remove all concerts from db; create blank slate..."""
@@ -226,3 +302,147 @@ class ConcertList(lma.DbList):
     @property
     def artistName(self):
         return(self._artist.name)
+
+#
+# date-ordered list of concerts across several artists
+#
+class ConcertTimeline(lma.DbList):
+    """Date-ordered list of concerts from a set of artists.
+
+    The artist set is either one of the TVIEW_SELECTORS or an explicit
+    sequence of artists (or artist ids).  The display mode and search
+    work as they do for ConcertList.  Concerts are read a page at a time,
+    walking the concert date index with keyset paging, so only the pages
+    actually looked at are ever fetched from the database."""
+
+    def __init__(self, db, artists=TVIEW_ALL,
+                 pagesize=TIMELINE_PAGE_SIZE):
+        self._artists = artists
+        self._mode = CVIEW_ALL
+        self._pagesize = pagesize
+        self._count = 0
+        self._key = None
+        self._complete = False
+        super(ConcertTimeline, self).__init__(db, Concert)
+
+    def _selection(self):
+        """Return the join/where clauses and args for the current settings."""
+        joins = []
+        where = []
+        args = []
+
+        # restrict by artist
+        if self._artists == TVIEW_FAVORITES:
+            joins.append("JOIN favorite AS fa ON fa.artistid = c.artistid")
+        elif self._artists != TVIEW_ALL:
+            ids = ",".join([str(int(a)) for a in self._artists])
+            where.append("c.artistid IN (%s)" % ids)
+
+        # modes use inner join to restrict output
+        if self.mode == CVIEW_FAVORITES:
+            joins.append("JOIN favconcert AS f ON f.concertid = c.cid")
+        elif self.mode == CVIEW_NEW:
+            joins.append("JOIN newconcert AS n ON n.cid = c.cid")
+        elif self.mode == CVIEW_DL:
+            joins.append("JOIN dlconcert AS d ON d.cid = c.cid")
+
+        if self.search:
+            where.append("c.ctitle LIKE ?")
+            args.append("%%%s%%" % self.search)
+
+        return (joins, where, args)
+
+    def refresh(self):
+        """Count the current selection and discard any pages read so far."""
+        (joins, where, args) = self._selection()
+        if where:
+            clause = "WHERE " + " AND ".join(where)
+        else:
+            clause = ""
+        c = self._db.cursor()
+        c.execute("SELECT COUNT(*) FROM concert AS c %s %s" %
+                  (" ".join(joins), clause), args)
+        self._count = int(c.fetchone()[0])
+        c.close()
+        self._data = []
+        self._key = None
+        self._complete = False
+
+    def pageAfter(self, key=None, count=None):
+        """Return a page of concert ids following the given key.
+
+        The key is a (date, id) pair, as returned by a previous call, or
+        None to start at the beginning.  Returns a tuple of the list of
+        concert ids and the key to use for the following page."""
+        if count == None:
+            count = self._pagesize
+        (joins, where, args) = self._selection()
+
+        # continue after the last concert returned
+        if key != None:
+            (kdate, kcid) = key
+            if kdate == None:
+                # undated concerts sort first
+                where.append("(c.cdate IS NOT NULL OR c.cid > ?)")
+                args.append(kcid)
+            else:
+                # the leading >= lets sqlite seek in the date index
+                where.append("c.cdate >= ? AND (c.cdate > ? OR c.cid > ?)")
+                args.extend([kdate, kdate, kcid])
+        if where:
+            clause = "WHERE " + " AND ".join(where)
+        else:
+            clause = ""
+
+        c = self._db.cursor()
+        c.execute("SELECT c.cid, c.cdate FROM concert AS c %s %s"
+                  "  ORDER BY c.cdate, c.cid LIMIT %d" %
+                  (" ".join(joins), clause, int(count)), args)
+        rows = c.fetchall()
+        c.close()
+
+        if rows:
+            key = (rows[-1][1], rows[-1][0])
+        return ([x[0] for x in rows], key)
+
+    def _fill(self, i):
+        """Read pages until index i is loaded (or we run out)."""
+        while i >= len(self._data) and not self._complete:
+            (ids, self._key) = self.pageAfter(self._key)
+            self._data.extend(ids)
+            if len(ids) < self._pagesize:
+                self._complete = True
+
+    # support reading like an array
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        self._fill(i)
+        return super(ConcertTimeline, self).__getitem__(i)
+    def __len__(self):
+        return self._count
+
+    # properties for each selection
+    @property
+    def mode(self):
+        """The current selection/display mode.
+
+        Setting this may trigger a refresh."""
+        return self._mode
+    @mode.setter
+    def mode(self, value):
+        assert(value in CVIEW_SELECTORS)
+        if self._mode != value:
+            self._mode = value
+            self.refresh()
+
+    @property
+    def artists(self):
+        """The artist set: a TVIEW selector or a sequence of artists.
+
+        Setting this triggers a refresh."""
+        return self._artists
+    @artists.setter
+    def artists(self, value):
+        self._artists = value
+        self.refresh()
@@ -114,6 +114,41 @@ class Config(object):
     def preferred_format(self, b):
         Config._data['preferred_format'] = str(b)
     @property
+    def harvest_details(self):
+        """Fetch concert details along with concert lists?"""
+        return Config._data['harvest_details']
+    @harvest_details.setter
+    def harvest_details(self, b):
+        Config._data['harvest_details'] = bool(b)
+    @property
+    def background_download(self):
+        """Queue songs to download in the background?"""
+        return Config._data['background_download']
+    @background_download.setter
+    def background_download(self, b):
+        Config._data['background_download'] = bool(b)
+    @property
+    def segmented_download(self):
+        """Download big files over several connections at once?"""
+        return Config._data['segmented_download']
+    @segmented_download.setter
+    def segmented_download(self, b):
+        Config._data['segmented_download'] = bool(b)
+    @property
+    def dedup_store(self):
+        """Keep one copy of songs that several concerts share?"""
+        return Config._data['dedup_store']
+    @dedup_store.setter
+    def dedup_store(self, b):
+        Config._data['dedup_store'] = bool(b)
+    @property
+    def scrub_readers(self):
+        """How many files to read at once when checking the library."""
+        return Config._data['scrub_readers']
+    @scrub_readers.setter
+    def scrub_readers(self, n):
+        Config._data['scrub_readers'] = int(n)
+    @property
     def shn_to_flac(self):
         """Auto-convert downloaded .shn files to .flac?"""
         return Config._data['shn_to_flac']
@@ -128,7 +163,12 @@ class Config(object):
             "lossless_path"    : None,
             "artist_subdir"    : True,
             "preferred_format" : 'lossless',
-            "shn_to_flac"      : False
+            "shn_to_flac"      : False,
+            "harvest_details"  : False,
+            "background_download" : False,
+            "segmented_download" : False,
+            "dedup_store"      : False,
+            "scrub_readers"    : 2
             }
     def makeConfig(self):
         """Set default configuration data"""
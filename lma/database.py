@@ -10,20 +10,27 @@
 Assuming sqlite3 for now.  May allow other DBs for shared access in
 future versions."""
 import sqlite3
+import struct
 
 import lma
 
 class ArDb(object):
     """Handle for a local Internet Archive database."""
 
-    def __init__(self, path):
-        """Open db and create tables if necessary."""
+    def __init__(self, path, timeout=5.0):
+        """Open db and create tables if necessary.
+
+        timeout is how long a statement waits for another connection's
+        lock before giving up with sqlite3.OperationalError (seconds)."""
         import os
         found = os.path.exists(str(path))
-        self._db = sqlite3.connect(str(path))
+        self._db = sqlite3.connect(str(path), timeout=timeout)
+        self._db.create_function("rank", 1, _fts_rank)
+        self._db.create_function("unpack_text", 1, lma.details.unpack_text)
 
         if not found:
             _populate_db(self._db)
+        _upgrade_db(self._db)
 
     def close(self):
         if self._db:
@@ -208,3 +215,145 @@ CREATE TABLE details (
     notes       TEXT
 );
 """)
+
+#
+# Relevance ranking for full-text searches
+#
+def _fts_rank(matchinfo):
+    """Score a full-text match, given the fts matchinfo 'pcx' blob.
+
+    Each phrase hit in a column scores the share of all that phrase's
+    hits in that column which are in this row, so rare words count for
+    more than common ones."""
+    info = struct.unpack("%dI" % (len(matchinfo) // 4), str(matchinfo))
+    (nphrase, ncol) = info[:2]
+    score = 0.0
+    for i in xrange(2, 2 + 3 * nphrase * ncol, 3):
+        if info[i]:
+            score += float(info[i]) / info[i + 1]
+    return score
+
+def _compress_details(db):
+    """Upgrade: compress the text already in the details table."""
+    import lma.details
+    lma.details.compress_details(db)
+    # give the space back
+    db.execute("VACUUM")
+
+def _index_details(db):
+    """Upgrade: full-text index the cached details and track titles."""
+    import lma.details
+    fields = ",".join(lma.details.meta_fields)
+    params = ",".join(["?"] * len(lma.details.meta_fields))
+    # (the compressed fields need unpacking for the index to read them)
+    text = ",".join([f in lma.details.compressed_fields and
+                     "unpack_text(%s) AS %s" % (f, f) or f
+                     for f in lma.details.meta_fields])
+    db.executescript("""
+-- full-text indexes of cached details and track titles.
+-- the text is in the tables named as 'content'; we keep these in step.
+DROP VIEW IF EXISTS details_text;
+CREATE VIEW details_text AS SELECT cid AS rowid, %s FROM details;
+CREATE VIRTUAL TABLE IF NOT EXISTS details_fts
+  USING fts4(content="details_text", %s);
+CREATE VIRTUAL TABLE IF NOT EXISTS files_fts
+  USING fts4(content="files", title);
+""" % (text, fields))
+    c = db.cursor()
+    c.execute("SELECT cid, %s FROM details" % fields)
+    c.executemany("INSERT INTO details_fts (docid, %s) VALUES (?, %s)" %
+                  (fields, params),
+                  [row[:1] + tuple(lma.details._unpack_details(row[1:]))
+                   for row in c.fetchall()])
+    c.execute("INSERT INTO files_fts (docid, title)"
+              "  SELECT fid, title FROM files WHERE title IS NOT NULL")
+    c.close()
+    db.commit()
+
+#
+# Schema upgrades, applied in order to bring older databases up to date.
+# Each entry is a (version, script) pair; the script is either SQL or a
+# callable taking the db handle.
+#
+_upgrades = [
+    (2, """
+-- date-ordered access to concerts, across artists or for a single artist
+CREATE INDEX IF NOT EXISTS concertdate ON concert (cdate);
+CREATE INDEX IF NOT EXISTS concertartist ON concert (artistid, cdate);
+"""),
+    (3, """
+-- highest publicdate seen, for incremental updates
+ALTER TABLE lma_config ADD COLUMN artist_watermark VARCHAR(20);
+ALTER TABLE lastbrowse ADD COLUMN watermark VARCHAR(20);
+"""),
+    (4, """
+-- cached file lists (from _files.xml)
+CREATE TABLE IF NOT EXISTS files (
+    fid      INTEGER UNIQUE PRIMARY KEY,
+    cid      INTEGER REFERENCES concert(cid),
+    name     VARCHAR(200) NOT NULL,
+    source   VARCHAR(20),
+    format   VARCHAR(50),
+    size     INTEGER,
+    md5      CHAR(32),
+    track    VARCHAR(10),
+    title    VARCHAR(200),
+    album    VARCHAR(200),
+    original VARCHAR(200)
+);
+CREATE INDEX IF NOT EXISTS filesconcert ON files (cid);
+"""),
+    (5, _compress_details),
+    (6, _index_details),
+    (7, """
+-- the background download queue, one row per file.
+-- state is one of queued, active, paused, done or failed.
+CREATE TABLE IF NOT EXISTS dlqueue (
+    qid      INTEGER PRIMARY KEY,
+    cid      INTEGER REFERENCES concert(cid),
+    name     VARCHAR(200) NOT NULL,
+    format   VARCHAR(50),
+    size     INTEGER,
+    md5      CHAR(32),
+    target   TEXT NOT NULL,
+    done     INTEGER DEFAULT 0,
+    state    VARCHAR(10) DEFAULT 'queued',
+    priority INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS dlqueuestate ON dlqueue (state, priority);
+CREATE INDEX IF NOT EXISTS dlqueueconcert ON dlqueue (cid);
+"""),
+    (8, """
+-- downloaded files whose checksums we've checked.
+-- the size and mtime are the file's when we checked it.
+CREATE TABLE IF NOT EXISTS libfile (
+    path  TEXT PRIMARY KEY,
+    cid   INTEGER REFERENCES concert(cid),
+    size  INTEGER,
+    mtime REAL,
+    md5   CHAR(32)
+);
+CREATE INDEX IF NOT EXISTS libfileconcert ON libfile (cid);
+"""),
+    (9, """
+-- when each file was last scrubbed, and when the scrub in progress began
+ALTER TABLE libfile ADD COLUMN scrubbed REAL;
+ALTER TABLE lma_config ADD COLUMN scrub_started REAL;
+"""),
+    ]
+
+def _upgrade_db(db):
+    """Apply any schema upgrades the database hasn't seen yet."""
+    version = db.execute("SELECT version FROM lma_config"
+                         "  WHERE recnum = 1").fetchone()[0]
+    for (newversion, script) in _upgrades:
+        if version >= newversion:
+            continue
+        if callable(script):
+            script(db)
+        else:
+            db.executescript(script)
+        db.execute("UPDATE lma_config SET version = ? WHERE recnum = 1",
+                   (newversion,))
+        db.commit()
+        version = newversion
@@ -8,11 +8,18 @@
 """Manage concert details info from the Archive.
 
 Unlike artists and concerts, this doesn't use the Query class to load
-details from the archive, because the details are stored in XML files."""
+details from the archive.  The details and file list for an item come
+from the Archive's json metadata document, or failing that, from the
+item's _meta.xml and _files.xml files."""
 
 import os
+import re
+import json
+import zlib
+import sqlite3
 import xml.sax
 import xml.sax.handler as xmlhandler
+import xml.parsers.expat
 import hashlib # for md5/sha1
 
 import lma
@@ -51,10 +58,111 @@ graphics_formats = [FMT_JPG, FMT_PNG, FMT_GIF]
 # key fields in archive XML files
 meta_fields = ["description", "coverage", "notes", "lineage",
                "taper", "transferer"]
+# fields we keep for each file (in database column order)
+file_fields = ["name", "source", "format", "size", "md5",
+               "track", "title", "album", "original"]
+
+#
+# compact record for one file's data
+#
+
+# one copy of each format and source string, shared by all the records
+_shared = {}
+
+# (these run for every file, so they test for None with 'is': comparing
+# a unicode string to None with == is surprisingly slow)
+def _share(value):
+    if value is None:
+        return None
+    return _shared.setdefault(value, value)
+
+def _size(value):
+    if value is None:
+        return None
+    return int(value)
+
+class FileRecord(object):
+    """The data for one file in an item.
+
+    Items can have thousands of files, so this keeps just the slots for
+    the file_fields, rather than a whole dict per file.  It still reads
+    like a dict, though; missing fields are simply not there.  The size
+    is kept as an int."""
+    __slots__ = file_fields
+    _fields = frozenset(file_fields)
+
+    def __init__(self, data=None, **fields):
+        # (data can be a dict or a list of pairs; copy it only if need be)
+        if data is None:
+            data = fields
+        elif fields or not isinstance(data, dict):
+            data = dict(data, **fields)
+        get = data.get
+        self.name = get("name")
+        self.source = _share(get("source"))
+        self.format = _share(get("format"))
+        self.size = _size(get("size"))
+        self.md5 = get("md5")
+        self.track = get("track")
+        self.title = get("title")
+        self.album = get("album")
+        self.original = get("original")
+
+    @classmethod
+    def empty(cls, name, source):
+        """Return a record with just the name and source, for a parser to
+        fill in field by field, without building a dict first."""
+        record = cls.__new__(cls)
+        record.name = name
+        record.source = _share(source)
+        record.format = record.size = record.md5 = None
+        record.track = record.title = record.album = record.original = None
+        return record
+
+    # dict-style access
+    def __getitem__(self, key):
+        value = getattr(self, key) if key in self._fields else None
+        if value == None:
+            raise KeyError(key)
+        return value
+    def __setitem__(self, key, value):
+        if not key in self._fields:
+            raise KeyError(key)
+        if key == "size":
+            value = _size(value)
+        elif key == "format" or key == "source":
+            value = _share(value)
+        setattr(self, key, value)
+    def __contains__(self, key):
+        return key in self._fields and getattr(self, key) != None
+    def get(self, key, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
+    def keys(self):
+        return [k for k in file_fields if k in self]
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, (FileRecord, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    def __repr__(self):
+        return "FileRecord(%r)" % dict(self.items())
 
 #
 # metadata SAX handler
 #
+# (The SAX handlers are no longer used for downloads, since the expat
+# parsers below do the same job much faster, but they're kept as the
+# reference for the parser benchmark.)
+#
 class MetaXMLHandler(xmlhandler.ContentHandler):
     """Parser for the _meta.xml file.
 
@@ -84,16 +192,48 @@ class MetaXMLHandler(xmlhandler.ContentHandler):
     def getData(self):
         return self._data
 
+#
+# metadata expat parser
+#
+class MetaXMLParser(object):
+    """Fast parser for the _meta.xml file.
+
+    Produces the same data as MetaXMLHandler, but uses expat callbacks
+    directly, with character data buffered into as few calls as
+    possible."""
+    def __init__(self):
+        self._data = {}
+        self._key = None
+        self._value = []
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._chars
+    def _start(self, name, attrs):
+        if name in meta_fields:
+            self._key = name
+            self._value = []
+    def _chars(self, content):
+        if self._key != None:
+            self._value.append(content)
+    def _end(self, name):
+        if self._key != None:
+            self._data[self._key] = "".join(self._value).strip(" \n")
+            self._key = None
+    def parse(self, stream):
+        """Parse the file-like object, and return the data."""
+        self._parser.ParseFile(stream)
+        return self._data
+
 def get_meta_data(lmaid):
     """Get the _meta.xml file with the concert description."""
     # relative path is concertid/concertid_meta.xml
-    reader = MetaXMLHandler()
     hand = lma.archive_open("%s/%s_meta.xml" % (lmaid, lmaid))
     try:
-        xml.sax.parse(hand, reader)
+        return MetaXMLParser().parse(hand)
     finally:
         hand.close()
-    return reader.getData()
 
 #
 # filelist SAX handler
@@ -137,7 +277,59 @@ class FileXMLHandler(xmlhandler.ContentHandler):
         pass
     def getData(self):
         return self._data
-                
+
+#
+# filelist expat parser
+#
+class FileXMLParser(object):
+    """Fast parser for the _files.xml file.
+
+    Produces the same data as FileXMLHandler, using expat directly,
+    but as FileRecords rather than dicts.  Each record is filled in as
+    its elements are read."""
+    _subelements = frozenset(['original', 'md5', 'format', 'album',
+                              'title', 'track', 'size'])
+    # elements whose values aren't kept as plain strings
+    _convert = {"size" : int, "format" : _share}
+    def __init__(self):
+        self._data = []
+        self._file = None
+        self._key = None
+        self._value = []
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._chars
+    # (FileRecords compare by value, so these test for None with 'is')
+    def _start(self, name, attrs):
+        if name == "file":
+            # found a new file
+            self._file = FileRecord.empty(attrs["name"], attrs["source"])
+        elif self._file is not None and name in self._subelements:
+            self._key = name
+            self._value = []
+    def _chars(self, content):
+        if self._key is not None:
+            self._value.append(content)
+    def _end(self, name):
+        if self._file is not None:
+            key = self._key
+            if key is not None:
+                value = "".join(self._value).strip(" \n")
+                convert = self._convert.get(key)
+                if convert is not None:
+                    value = convert(value)
+                setattr(self._file, key, value)
+                self._key = None
+            elif name == "file":
+                self._data.append(self._file)
+                self._file = None
+    def parse(self, stream):
+        """Parse the file-like object, and return the data."""
+        self._parser.ParseFile(stream)
+        return self._data
+
 #
 # routines for downloading the filelist
 #
@@ -145,82 +337,345 @@ class FileXMLHandler(xmlhandler.ContentHandler):
 def get_filelist_data(lmaid):
     """Get the _files.xml file with the song listing."""
     # relative path is concertid/concertid_files.xml
-    reader = FileXMLHandler()
     hand = lma.archive_open("%s/%s_files.xml" % (lmaid, lmaid))
     try:
-        xml.sax.parse(hand, reader)
+        return FileXMLParser().parse(hand)
     finally:
         hand.close()
-    return reader.getData()
 
 
-def organize_filelist(files):
-    """organize the file data into something useful."""
+def store_filelist(cursor, cid, files):
+    """Write the file list for a concert into the files table.
 
-    songs = {}
-    derivatives = {}
-    other = []
-    lossless = ""
+    Replaces any list already stored for the concert.  The track titles
+    are added to the full-text index."""
+    # (the index reads the old titles from the files table to forget
+    # them, so this has to go first)
+    cursor.execute("DELETE FROM files_fts WHERE docid IN"
+                   "  (SELECT fid FROM files WHERE cid = ?)", (str(cid),))
+    cursor.execute("DELETE FROM files WHERE cid = ?", (str(cid),))
+    rows = [[str(cid)] + [f.get(k) for k in file_fields] for f in files]
+    cursor.executemany("INSERT INTO files (cid, %s) VALUES (?, %s)" %
+                       (",".join(file_fields),
+                        ",".join(["?"] * len(file_fields))), rows)
+    cursor.execute("INSERT INTO files_fts (docid, title)"
+                   "  SELECT fid, title FROM files"
+                   "  WHERE cid = ? AND title IS NOT NULL", (str(cid),))
+
+def load_filelist(cursor, cid):
+    """Read a concert's file list from the files table.
+
+    Returns the same structure as get_filelist_data(), or None if
+    there's nothing stored for the concert."""
+    cursor.execute("SELECT %s FROM files WHERE cid = ? ORDER BY fid" %
+                   ",".join(file_fields), (str(cid),))
+    rows = cursor.fetchall()
+    if len(rows) == 0:
+        return None
+    return [FileRecord(zip(file_fields, row)) for row in rows]
 
-    # we're going to sort with lower-case formats, but we want to be
-    # able to recover the mixed-case formats for a nice display after.
-    # this translate table will help us achieve that.
-    xlate_fmt = {}
+#
+# routines for getting the details and filelist in one go
+#
 
+def _json_files(files):
+    """Convert the file list from the json metadata to the XML form."""
+    result = []
     for f in files:
-        f_name = f['name']
+        data = FileRecord(name=f["name"])
+        for k in file_fields[1:]:
+            if k in f:
+                data[k] = _flatten(f[k])
+        result.append(data)
+    return result
+
+def get_item_data(lmaid):
+    """Get both the concert description and the song listing.
+
+    This only takes one request, for the item's json metadata, but if
+    that doesn't work out, we fall back to the XML files.  Returns a
+    tuple of the same data get_meta_data() and get_filelist_data()
+    return."""
+    try:
+        hand = lma.archive_open(lmaid, metadata=True)
+        try:
+            data = json.load(hand)
+        finally:
+            hand.close()
+        meta = data["metadata"]
+        files = _json_files(data["files"])
+    except (IOError, ValueError, KeyError, TypeError):
+        return (get_meta_data(lmaid), get_filelist_data(lmaid))
+    return ({k : _flatten(meta[k]) for k in meta_fields if k in meta}, files)
+
+def is_cached(cursor, cid):
+    """Check whether a concert's details and file list are both cached."""
+    cursor.execute("SELECT (SELECT COUNT(*) FROM details WHERE cid = ?),"
+                   "  EXISTS (SELECT 1 FROM files WHERE cid = ?)",
+                   (str(cid), str(cid)))
+    (details, files) = cursor.fetchone()
+    return bool(details and files)
+
+def store_item(cursor, cid, lmaid, meta, files):
+    """Cache the data returned by get_item_data() for one concert."""
+    store_details(cursor, [[lmaid] + [meta.get(k, u"") for k in meta_fields]])
+    store_filelist(cursor, cid, files)
+
+def load_item(db, concert):
+    """Fetch a concert's details and file list, and cache them both.
+
+    Returns the tuple from get_item_data()."""
+    (meta, files) = get_item_data(concert.lmaid)
+    c = db.cursor()
+    store_item(c, concert, concert.lmaid, meta, files)
+    c.close()
+    db.commit()
+    return (meta, files)
+
+# (for choosing the main lossless set when there's more than one)
+_lossless_rank = {fmt : i for i, fmt in enumerate(lossless_audio_formats)}
+_lossy_formats = frozenset(lossy_audio_formats)
+
+_digits = re.compile(r"(\d+)")
+
+def natural_key(name):
+    """Sort key that puts numbers in numeric order, so t2 comes before t10.
+
+    Disc numbers come before track numbers in the Archive's names (as
+    in 'gd77-05-08d2t10.flac'), so this gets the discs right, too."""
+    parts = _digits.split(name.lower())
+    parts[1::2] = [int(n) for n in parts[1::2]]
+    return parts
+
+def organize_filelist(files):
+    """organize the file data into something useful.
+
+    Returns a table of songs in track order, with a column for each
+    format, a list of the other files, and a list of the formats.  The
+    lossless formats come first, with the main one (the one with the
+    most songs) at the head of the list.  Each derivative is lined up
+    with its original; the originals in any further lossless sets are
+    lined up with the main set in order.  Missing songs are None."""
 
+    # sort the files into the sets in a single pass.  we key the sets
+    # on lower-case formats, but keep the mixed-case formats from the
+    # files for a nice display after.
+    originals = {}
+    derivatives = {}
+    names = {}
+    other = []
+    for f in files:
         # make sure all of these have a title field
         if not 'title' in f:
-            f['title'] = f_name
+            f['title'] = f['name']
 
-        # find the file's format
-        if not 'format' in f:
+        f_format = f.get('format')
+        if f_format == None:
             other.append(f)
             continue
-
-        f_format = f['format']
         f_formatlc = f_format.lower()
-        f_source = f['source'].lower()
 
-        # lossless audio formats will always be the original
-        if f_formatlc in lossless_audio_formats:
-            songs[f_name] = f
-            lossless = f_format
+        if f_formatlc in _lossless_rank:
+            # lossless audio formats will always be the original
+            group = originals
+        elif f_formatlc in _lossy_formats and 'original' in f:
+            group = derivatives
+        else:
+            other.append(f)
             continue
+        if f_formatlc in group:
+            group[f_formatlc].append(f)
+        else:
+            group[f_formatlc] = [f]
+            names[f_formatlc] = f_format
 
-        # check for derivative audio file
-        if f_formatlc in lossy_audio_formats and 'original' in f:
-            # now we make the translate table (only needs lossy formats)
-            derivatives.setdefault(f_formatlc, {})[f['original']] = f
-            xlate_fmt[f_formatlc] = f_format
-            continue
+    # the main set first, then any others in our order of preference
+    sets = sorted(originals, key=lambda fmt: (-len(originals[fmt]),
+                                              _lossless_rank[fmt]))
+    columns = []
+    for fmt in sets:
+        originals[fmt].sort(key=lambda f: natural_key(f['name']))
+        columns.append(originals[fmt])
+    rows = max([len(column) for column in columns] or [0])
+    for column in columns:
+        column.extend([None] * (rows - len(column)))
 
-        # everything else goes in other
-        other.append(f)
-
-    # now sort the song filenames alphabetically
-    tracks = songs.keys()
-    tracks.sort()
-    # build a 2d list of songs in track order
-    songlist = []
-    for trk in tracks:
-        item = [songs[trk]]
-        for fmt in lossy_audio_formats:
-            if fmt in derivatives:
-                if trk in derivatives[fmt]:
-                    item.append(derivatives[fmt][trk])
-                else: 
-                    # we hope this never happens
-                    item.append(None)
-        songlist.append(item)
-    # now build a table of formats using our xlate_table from above
-    fmtlist = [lossless]
-    for k in derivatives:
-        fmtlist.append(xlate_fmt[k])
+    # find the row for each original, and put the derivatives there
+    row_of = {}
+    for column in columns:
+        for row, f in enumerate(column):
+            if f != None:
+                row_of[f['name']] = row
+    lossy = [fmt for fmt in lossy_audio_formats if fmt in derivatives]
+    if rows == 0:
+        # nothing to line them up with
+        other.extend([f for fmt in lossy for f in derivatives[fmt]])
+        lossy = []
+    for fmt in lossy:
+        column = [None] * rows
+        for f in derivatives[fmt]:
+            row = row_of.get(f['original'])
+            if row == None:
+                # not made from any of our songs
+                other.append(f)
+            else:
+                column[row] = f
+        columns.append(column)
 
+    songlist = [list(item) for item in zip(*columns)]
+    fmtlist = [names[fmt] for fmt in sets + lossy] or [""]
     return (songlist, other, fmtlist)
 
+def _flatten(value):
+    """Turn a field value from the Archive's json into a single string.
+
+    Fields with several values come back as lists; we join them."""
+    if isinstance(value, list):
+        value = u"\n".join([unicode(v) for v in value])
+    elif not isinstance(value, basestring):
+        value = unicode(value)
+    return value.strip(" \n")
+
+#
+# compression for the big text fields in the details table
+#
+
+# these can run to many kilobytes each
+compressed_fields = ["description", "notes", "lineage"]
+
+# Text that turns up over and over in LMA descriptions, lineages and
+# notes.  Compression starts out with this already "seen", so even short
+# fields compress well.  (Python 2's zlib has no preset dictionaries, so
+# we prime the compressor by hand; see _TextCodec.)  The most common
+# stuff goes last, where it's cheapest to refer back to.
+# Never change this!  Make a new version with a new marker instead.
+_TEXT_DICTIONARY = (
+    u"Recorded by Transferred by Taped by Seeded by Uploaded by "
+    u"Thanks to the band for allowing taping and trading. "
+    u"Please support the band by buying their official releases and "
+    u"going to their shows.  Not for sale!  Do not convert to mp3 and "
+    u"trade as lossless.  Share freely.  Comments welcome. "
+    u"Source: Audience Soundboard SBD AUD Matrix FOB DFC OTS "
+    u"Schoeps CMC6 MK4 MK41 Neumann KM184 AKG C480 Sennheiser MKH "
+    u"Microtech Gefell DPA 4021 4022 Beyerdynamic Nakamichi CM-300 "
+    u"Church Audio Busman Oade Edirol R-09 R-44 Zoom H2 H4n Sony PCM-M10 "
+    u"Tascam DR-40 DR-680 Marantz PMD-661 Sound Devices 722 744T "
+    u"Lineage: > DAT > CD-R > EAC > WAV > SHN > FLAC > CDWave > "
+    u"Sound Forge > Audacity > Samplitude > Wavelab > Adobe Audition > "
+    u"Traders Little Helper > xACT > foobar2000 > flac level 8 "
+    u"16bit/44.1kHz 24bit/48kHz 24bit/96kHz dithered resampled "
+    u"fades added tracked normalized no EQ md5 ffp st5 checksums "
+    u"Disc One Disc Two Disc Three Set I Set II Set 1 Set 2 Encore: "
+    u"-> > crowd tuning banter intro jam set break drums space "
+    u"Notes: Taper: Transfer: Setlist: Location: Venue: Date: "
+    u"<br /><br />\n<a href=\"http://www.archive.org/details/\">"
+    u"</a>\n<p>\n</p>\n"
+    ).encode("utf-8")
+
+class _TextCodec(object):
+    """Compress and decompress text, with a priming dictionary.
+
+    Compressed values start with a version marker byte, and are stored
+    as BLOBs, so they're easy to tell from the plain TEXT values stored
+    by older versions (or which weren't worth compressing)."""
+    marker = "\x01"
+    threshold = 100 # don't bother with anything smaller than this
+
+    def __init__(self, dictionary):
+        # compress the dictionary once, flushing so it ends on a byte
+        # boundary; copies of the compressor then carry on from there.
+        self._comp = zlib.compressobj(9)
+        prefix = self._comp.compress(dictionary)
+        prefix += self._comp.flush(zlib.Z_SYNC_FLUSH)
+        # likewise, a decompressor which has already read the dictionary
+        self._decomp = zlib.decompressobj()
+        self._decomp.decompress(prefix)
+
+    def pack(self, text):
+        """Return the value to store for text (compressed if worthwhile)."""
+        if isinstance(text, buffer) or len(text) < self.threshold:
+            return text
+        comp = self._comp.copy()
+        data = comp.compress(text.encode("utf-8")) + comp.flush()
+        if len(data) + 1 >= len(text):
+            return text
+        return sqlite3.Binary(self.marker + data)
+
+    def unpack(self, value):
+        """Return the text for a stored value."""
+        if not isinstance(value, buffer):
+            return value
+        data = str(value)
+        assert data[0] == self.marker
+        decomp = self._decomp.copy()
+        text = decomp.decompress(data[1:]) + decomp.flush()
+        return text.decode("utf-8")
+
+_codec = _TextCodec(_TEXT_DICTIONARY)
+
+def unpack_text(value):
+    """Return the text for a value stored in a compressed field.
+
+    This is also available to SQL, under the same name."""
+    return _codec.unpack(value)
+
+# (positions of the compressed fields in meta_fields)
+_packed = [i for i, field in enumerate(meta_fields)
+           if field in compressed_fields]
+
+def _pack_details(values):
+    """Compress the big fields in a row of meta_fields values."""
+    for i in _packed:
+        values[i] = _codec.pack(values[i])
+    return values
+
+def _unpack_details(values):
+    """Decompress the big fields in a row of meta_fields values."""
+    values = list(values)
+    for i in _packed:
+        values[i] = _codec.unpack(values[i])
+    return values
+
+def store_details(cursor, rows):
+    """Write details for several concerts into the details table.
+
+    Each row is the concert's LMA identifier followed by the values for
+    the meta_fields, in order, as returned by an Archive search.  Rows
+    for concerts we don't know about are ignored.  The big text fields
+    are stored compressed, and everything is added to the full-text
+    index."""
+    fields = ",".join(meta_fields)
+    params = ",".join(["?"] * len(meta_fields))
+
+    # find the concert ids
+    new = []
+    for row in rows:
+        cursor.execute("SELECT cid FROM concert WHERE lmaid = ?", (row[0],))
+        found = cursor.fetchone()
+        if found != None:
+            new.append([found[0]] + [_flatten(v) for v in row[1:]])
+
+    # (the index reads the old text, through the details_text view, to
+    # forget it, so this has to go first)
+    cursor.executemany("DELETE FROM details_fts WHERE docid = ?",
+                       [row[:1] for row in new])
+    cursor.executemany("INSERT INTO details_fts (docid, %s)"
+                       "  VALUES (?, %s)" % (fields, params), new)
+    cursor.executemany("INSERT OR REPLACE INTO details (cid, %s)"
+                       "  VALUES (?, %s)" % (fields, params),
+                       [row[:1] + _pack_details(row[1:]) for row in new])
+
+def compress_details(db):
+    """Compress any uncompressed big text fields in the details table."""
+    fields = ",".join(meta_fields)
+    c = db.cursor()
+    c.execute("SELECT cid, %s FROM details" % fields)
+    rows = [_pack_details(list(row[1:])) + [row[0]] for row in c.fetchall()]
+    c.executemany("UPDATE details SET %s WHERE cid = ?" %
+                  ",".join(["%s = ?" % f for f in meta_fields]), rows)
+    c.close()
+    db.commit()
+
 #
 # Concert details, like description, notes, etc.
 #
@@ -228,7 +683,8 @@ class ConcertDetails(object):
     """Wrapper class for concert details.
 
     We get them from the LMA unless we have them cached locally.
-    We don't save them (cache them) unless specifically asked."""
+    Fetching them also caches the concert's file list, since both come
+    in the same download."""
     def __init__(self, db, concert):
         """Get the details either from local cache or the LMA."""
         self._db = db
@@ -240,25 +696,21 @@ class ConcertDetails(object):
             self.loadFromArchive()
 
     def loadFromArchive(self):
-        """Get the details from the Archive."""
-        lmaid = self._concert.lmaid
-        self._data = get_meta_data(lmaid)
+        """Get the details from the Archive (and cache them)."""
+        (self._data, files) = load_item(self._db, self._concert)
         # make sure we have all fields defined
         for field in meta_fields:
             if not field in self._data:
                 self._data[field] = ""
+        self._saved = True
 
     def saveToCache(self):
         """Write the details to the cache if necessary."""
         if self._saved == True:
             return
         c = self._db.cursor()
-        # make text versions of field list, with and without colons
-        f1 = ",".join(meta_fields)
-        f2 = ":" + ", :".join(meta_fields)
-        # use field lists to insert into database
-        c.execute("INSERT OR REPLACE INTO details"
-                  " (cid, %s) VALUES (:cid, %s)" % (f1, f2), self._data)
+        store_details(c, [[self._concert.lmaid] +
+                          [self._data[k] for k in meta_fields]])
         c.close()
         self._db.commit()
         self._saved = True
@@ -274,7 +726,8 @@ class ConcertDetails(object):
         c.close()
         if result == None:
             return
-        self._data = {x : y  for x,y in zip(meta_fields, result)}
+        self._data = {x : y  for x,y in zip(meta_fields,
+                                            _unpack_details(result))}
         self._saved = True
 
     @property
@@ -289,31 +742,53 @@ class ConcertDetails(object):
 #
 
 class ConcertFileList(object):
-    """Represents a list of songs for a given show."""
-    def __init__(self, concert):
+    """Represents a list of songs for a given show.
+
+    The list is read from the local cache if we have it; otherwise it's
+    fetched from the Archive and cached for next time."""
+    def __init__(self, db, concert):
+        self._db = db
         self.concert = concert
-        self.loadFromArchive()
+        if not self.loadFromCache():
+            self.loadFromArchive()
 
     def loadFromArchive(self):
-        """Get Files/Songlist from Archive."""
-        data = get_filelist_data(self.concert.lmaid)
+        """Get Files/Songlist from Archive (and cache it).
+
+        This caches the concert details as well."""
+        (meta, data) = load_item(self._db, self.concert)
+        self._organize(data)
+
+    def loadFromCache(self):
+        """Get Files/Songlist from the db.  Returns False if not there."""
+        c = self._db.cursor()
+        data = load_filelist(c, self.concert)
+        c.close()
+        if data == None:
+            return False
+        self._organize(data)
+        return True
+
+    def _organize(self, data):
+        """Set up the songlist from the raw file data."""
         (self._songs, self.others, self.formats) = organize_filelist(data)
-        # this converts a type into a column# for the songs table
-        self._idx = {fmt : i for i,fmt in enumerate(self.formats)}
+        # the songs in each format, leaving out the gaps in the table
+        # (a second lossless set may be short a song or two)
+        self._sets = {fmt : [row[i] for row in self._songs if row[i] != None]
+                      for i, fmt in enumerate(self.formats)}
         # default to first (lossless) format
         self.current_format = self.LosslessFormat()
 
     # support reading like an array
     # (need to add access to self._other too at some point)
     def __len__(self):
-        return len(self._songs)
+        return len(self._sets[self.current_format])
     def __getitem__(self, i):
         """Return a song of the currently selected format"""
-        return self._songs[i][self._idx[self.current_format]]
+        return self._sets[self.current_format][i]
     def __iter__(self):
         """Create an iterator for the songs"""
-        for song in self._songs:
-            yield song[self._idx[self.current_format]]
+        return iter(self._sets[self.current_format])
     @property
     def current_format(self):
         return self._current_format
@@ -322,7 +797,256 @@ class ConcertFileList(object):
         if value in self.formats:
             self._current_format = value
     def hasLossy(self):
-        return len(self.formats) > 1
+        return (len(self.formats) > 1 and
+                not self.isLossless(self.formats[-1]))
+    def isLossless(self, format):
+        """Return True if the format is one of the lossless sets."""
+        return format.lower() in _lossless_rank
     def LosslessFormat(self):
         """Return the lossless format for this concert"""
         return self.formats[0]
+
+def _benchmark(nfiles=10000, repeat=3):
+    """Time the SAX handlers against the expat parsers, and then time
+    organize_filelist() on the result.
+
+    Run with 'python -m lma.details bench' from the top directory."""
+    import time
+    import random
+    from StringIO import StringIO
+
+    # a synthetic multi-format item: flac originals plus two derivatives
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<files>\n']
+    for i in xrange(nfiles // 3):
+        orig = "lma2001-01-01d%dt%d.flac" % (i // 100 + 1, i % 100 + 1)
+        parts.append('  <file name="%s" source="original">\n'
+                     '    <format>Flac</format>\n    <size>%d</size>\n'
+                     '    <md5>%032x</md5>\n    <title>Song &amp; %d</title>\n'
+                     '    <track>%d</track>\n  </file>\n' %
+                     (orig, 30000000 + i, i, i, i + 1))
+        for ext, fmt in [("mp3", "VBR MP3"), ("ogg", "Ogg Vorbis")]:
+            parts.append('  <file name="%s.%s" source="derivative">\n'
+                         '    <format>%s</format>\n    <size>%d</size>\n'
+                         '    <md5>%032x</md5>\n    <original>%s</original>\n'
+                         '  </file>\n' % (orig[:-5], ext, fmt, 5000000 + i,
+                                          i, orig))
+    parts.append('</files>\n')
+    doc = "".join(parts)
+
+    # (both end up with FileRecords, as get_filelist_data() returns)
+    def sax(data):
+        reader = FileXMLHandler()
+        xml.sax.parse(StringIO(data), reader)
+        return [FileRecord(f) for f in reader.getData()]
+    def expat(data):
+        return FileXMLParser().parse(StringIO(data))
+
+    assert sax(doc) == expat(doc)
+    for name, parse in [("SAX handler", sax), ("expat parser", expat)]:
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            parse(doc)
+            elapsed = time.time() - start
+            if best == None or elapsed < best:
+                best = elapsed
+        print("%-12s %6d files: %7.1f ms" % (name, nfiles // 3 * 3,
+                                              best * 1000))
+
+    # the file lists come in no particular order
+    files = expat(doc)
+    random.shuffle(files)
+    (songs, other, formats) = organize_filelist(files)
+    assert formats == ["Flac", "Ogg Vorbis", "VBR MP3"] and not other
+    assert [s[0]['name'] for s in songs[:3]] == [
+        "lma2001-01-01d1t1.flac", "lma2001-01-01d1t2.flac",
+        "lma2001-01-01d1t3.flac"]
+    assert songs[100][0]['name'] == "lma2001-01-01d2t1.flac"
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        organize_filelist(files)
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    print("%-12s %6d files: %7.1f ms" % ("organize", len(files),
+                                          best * 1000))
+
+def _serve_items(pages):
+    """Serve the given pages (a dict of path : body) on a local port.
+
+    Returns the server; anything else gets a 404.  (Check server.)"""
+    import threading
+    import BaseHTTPServer
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = pages.get(self.path)
+            if body == None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def _check_item_data():
+    """Check get_item_data() against a local stub of the Archive.
+
+    Covers the json metadata, and the fallback to the XML files when
+    the json is missing, malformed, or has no usable file list."""
+    import lma.query
+
+    meta = {"description" : "Set 1", "taper" : ["Bob", "Ann"]}
+    files = [{"name" : "gd77t01.flac", "source" : "original",
+              "format" : "Flac", "size" : "1234", "md5" : "a" * 32,
+              "title" : "Bertha", "track" : "1"},
+             {"name" : "gd77t01.mp3", "source" : "derivative",
+              "format" : "VBR MP3", "size" : "100",
+              "original" : "gd77t01.flac"}]
+    xml_meta = ('<?xml version="1.0" encoding="UTF-8"?>\n<metadata>'
+                '<description>Set 1 (xml)</description>'
+                '<taper>Bob</taper></metadata>\n')
+    xml_files = ('<?xml version="1.0" encoding="UTF-8"?>\n<files>'
+                 '<file name="gd77t01.shn" source="original">'
+                 '<format>Shorten</format><size>99</size>'
+                 '<md5>%s</md5></file></files>\n' % ("b" * 32))
+    items = {"ok" : json.dumps({"metadata" : meta, "files" : files}),
+             "badjson" : '{"metadata": {',
+             "nofiles" : json.dumps({"metadata" : meta}),
+             "badfiles" : json.dumps({"metadata" : meta, "files" : "x"}),
+             "noname" : json.dumps({"metadata" : meta,
+                                    "files" : [{"format" : "Flac"}]}),
+             "empty" : "{}",
+             "missing" : None}
+    pages = {}
+    for (lmaid, body) in items.items():
+        if body != None:
+            pages["/metadata/%s" % lmaid] = body
+        pages["/download/%s/%s_meta.xml" % (lmaid, lmaid)] = xml_meta
+        pages["/download/%s/%s_files.xml" % (lmaid, lmaid)] = xml_files
+
+    server = _serve_items(pages)
+    saved = lma.query.ARCHIVE_URL
+    lma.query.ARCHIVE_URL = "http://127.0.0.1:%d" % server.server_port
+    try:
+        (m, f) = get_item_data("ok")
+        assert m == {"description" : "Set 1", "taper" : "Bob\nAnn"}, m
+        assert [r['name'] for r in f] == ["gd77t01.flac", "gd77t01.mp3"]
+        assert f[0]['size'] == 1234 and f[0]['title'] == "Bertha"
+        assert f[1]['original'] == "gd77t01.flac" and not 'md5' in f[1]
+        for lmaid in items:
+            if lmaid == "ok":
+                continue
+            (m, f) = get_item_data(lmaid)
+            assert m == {"description" : "Set 1 (xml)", "taper" : "Bob"}, \
+                   (lmaid, m)
+            assert [(r['name'], r['format']) for r in f] == [
+                ("gd77t01.shn", "Shorten")], (lmaid, f)
+    finally:
+        lma.query.ARCHIVE_URL = saved
+        server.shutdown()
+    print("item data: ok")
+
+def _files_xml(entries):
+    """Make a _files.xml document from (name, source, format, original)."""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<files>\n']
+    for (i, (name, source, format, original)) in enumerate(entries):
+        parts.append('  <file name="%s" source="%s">\n'
+                     '    <format>%s</format>\n    <size>%d</size>\n'
+                     '    <md5>%032x</md5>\n' %
+                     (name, source, format, 1000 + i, i))
+        if original != None:
+            parts.append('    <original>%s</original>\n' % original)
+        parts.append('  </file>\n')
+    parts.append('</files>\n')
+    return "".join(parts)
+
+def _check_organize():
+    """Check organize_filelist() and ConcertFileList on the kinds of file
+    lists real items have."""
+    from StringIO import StringIO
+
+    def organize(entries):
+        files = FileXMLParser().parse(StringIO(_files_xml(entries)))
+        # (a file list without a database behind it)
+        songs = ConcertFileList.__new__(ConcertFileList)
+        songs._organize(files)
+        return songs
+    def names(songs, format):
+        songs.current_format = format
+        return [song['name'] for song in songs]
+
+    # shn originals, with a later flac transfer that's a track short,
+    # and derivatives made from the flacs.  discs and unpadded tracks.
+    entries = []
+    for (d, t) in [(1, t) for t in range(1, 11)] + [(2, 1), (2, 2)]:
+        base = "gd77-05-08d%dt%d" % (d, t)
+        entries.append((base + ".shn", "original", "Shorten", None))
+        if (d, t) != (2, 2):
+            entries.append((base + ".flac", "original", "Flac", None))
+            entries.append((base + ".mp3", "derivative", "VBR MP3",
+                            base + ".flac"))
+    entries += [("gd77-05-08.txt", "original", "Text", None),
+                ("gd77-05-08.ffp", "original", "Checksums", None),
+                ("gd77-05-08.jpg", "original", "JPEG", None),
+                ("gd77-05-08_files.xml", "original", "Metadata", None)]
+    entries.reverse()
+    songs = organize(entries)
+    assert songs.formats == ["Shorten", "Flac", "VBR MP3"], songs.formats
+    assert songs.current_format == "Shorten" and len(songs) == 12
+    assert names(songs, "Shorten")[8:] == [
+        "gd77-05-08d1t9.shn", "gd77-05-08d1t10.shn",
+        "gd77-05-08d2t1.shn", "gd77-05-08d2t2.shn"]
+    flacs = names(songs, "Flac")
+    assert len(flacs) == len(songs) == 11 and not None in list(songs)
+    assert flacs[-1] == "gd77-05-08d2t1.flac"
+    assert names(songs, "VBR MP3") == [n[:-4] + "mp3" for n in flacs]
+    assert sum([song['size'] for song in songs]) > 0
+    assert sorted([f['name'] for f in songs.others]) == [
+        "gd77-05-08.ffp", "gd77-05-08.jpg", "gd77-05-08.txt",
+        "gd77-05-08_files.xml"]
+    assert not songs.isLossless("VBR MP3") and songs.hasLossy()
+
+    # 16 and 24 bit sets of the same size: 16 bit first
+    entries = []
+    for t in range(1, 4):
+        entries.append(("ph1995-12-31t0%d.flac" % t, "original", "Flac",
+                        None))
+        entries.append(("24bit/ph1995-12-31t0%d.flac" % t, "original",
+                        "24bit Flac", None))
+        entries.append(("ph1995-12-31t0%d.ogg" % t, "derivative",
+                        "Ogg Vorbis", "24bit/ph1995-12-31t0%d.flac" % t))
+    songs = organize(entries)
+    assert songs.formats == ["Flac", "24bit Flac", "Ogg Vorbis"]
+    assert names(songs, "24bit Flac")[0] == "24bit/ph1995-12-31t01.flac"
+    assert names(songs, "Ogg Vorbis")[2] == "ph1995-12-31t03.ogg"
+
+    # derivatives only (the originals weren't listed), and a bare item
+    songs = organize([("x-t1.mp3", "derivative", "VBR MP3", "x-t1.wav"),
+                      ("x.txt", "original", "Text", None)])
+    assert songs.formats == [""] and len(songs) == 0
+    assert len(songs.others) == 2 and not songs.hasLossy()
+    songs = organize([])
+    assert songs.formats == [""] and list(songs) == []
+    print("organize: ok")
+
+def _check():
+    """Run the checks.
+
+    Run with 'python -m lma.details check' from the top directory."""
+    _check_item_data()
+    _check_organize()
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ["bench"]:
+        _benchmark()
+    elif sys.argv[1:] == ["check"]:
+        _check()
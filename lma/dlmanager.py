@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# Part of the Live Music Archive access library (lma)
+#
+# This library is copyright 2012 by Chris Waters.
+# It is licensed under a liberal MIT/X11 style license;
+# see the file "LICENSE" in this directory for details.
+
+"""Download songs in the background.
+
+The DownloadManager keeps a queue of songs to download in the
+database, so nothing is lost if the program exits part way through;
+the queue simply picks up again the next time a manager is started.
+Partly downloaded songs are resumed, rather than started over."""
+
+import time
+import sqlite3
+import httplib
+import threading
+
+import lma
+import lma.download
+
+# states for the songs in the queue
+DL_QUEUED = "queued"
+DL_ACTIVE = "active"
+DL_PAUSED = "paused"
+DL_DONE = "done"
+DL_FAILED = "failed"
+
+DB_TIMEOUT = 30     # how long a worker waits for a locked database (seconds)
+DB_RETRY = 1        # then how long it pauses before trying again (doubling,
+DB_RETRY_MAX = 30   #  up to this)
+CHECKPOINT = 10     # how often a song's progress is saved (seconds)
+
+class _QueueProgress(object):
+    """Progress bar stand-in for a song being downloaded by a worker."""
+    def __init__(self, manager, db, qid):
+        self._manager = manager
+        self._db = db
+        self._qid = qid
+        self._saved = time.time()
+    def update(self, count):
+        self._manager._done[self._qid] = count
+        if time.time() - self._saved >= CHECKPOINT:
+            self._manager._checkpoint(self._db, self._qid, count)
+            self._saved = time.time()
+        return not self._qid in self._manager._halt
+
+class DownloadManager(object):
+    """Background downloader with a queue that survives restarts.
+
+    A pool of worker threads, each with its own database handle, takes
+    songs from the queue, highest priority first, then in the order they
+    were queued.  When all of a concert's queued songs have arrived, the
+    concert is marked as downloaded, and its songs leave the queue.
+
+    Only one manager should be run on a database at a time.  The queue
+    methods use the manager's own database handle, so they should be
+    called from the thread that created the manager.  The workers wait
+    out any long transaction on that handle (or another), trying again
+    now and then, so the queue can be changed at any time."""
+
+    def __init__(self, dbpath, workers=lma.download.DOWNLOAD_WORKERS,
+                 per_host=lma.download.HOST_CONNECTIONS, segments=1,
+                 store=None, post=None):
+        """dbpath is the path to the database file.
+
+        The other arguments are as for lma.download_files().  The
+        segments, store and post can be changed later, through the
+        attributes of the same names."""
+        self._dbpath = dbpath
+        self.segments = segments
+        self.store = store
+        self.post = post
+        self._db = lma.ArDb(dbpath)
+        self._limiter = lma.download._HostLimiter(per_host)
+        self._cond = threading.Condition()
+        self._claim = threading.Lock() # (between workers only)
+        self._changes = 0 # counts changes to the queue, for idle workers
+        self._active = {} # qid -> cid, for the songs being downloaded
+        self._done = {}   # qid -> bytes so far, for the same
+        self._halt = set() # active songs to stop (paused or shutting down)
+        self._stopped = False
+
+        # anything that was active last time was cut off; start it again
+        self._db.execute("UPDATE dlqueue SET state = ? WHERE state = ?",
+                         (DL_QUEUED, DL_ACTIVE))
+        self._db.commit()
+
+        self._threads = [threading.Thread(target=self._work)
+                         for i in xrange(workers)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    #
+    # queue operations
+    #
+    def enqueue(self, songlist, concert, targetdir, artist=None,
+                format=None, priority=0):
+        """Queue songs for download, as for lma.download_files().
+
+        Songs already in the queue for the same place are left where
+        they are, so two workers never fetch the same file; failed ones
+        are tried again."""
+        target = lma.download.concert_dir(concert, targetdir, artist)
+        songs = [(str(concert), song['name'], target) for song in songlist]
+        with self._cond:
+            self._db.executemany(
+                "UPDATE dlqueue SET state = ?, priority = ?"
+                "  WHERE cid = ? AND name = ? AND target = ? AND state = ?",
+                [(DL_QUEUED, priority) + song + (DL_FAILED,)
+                 for song in songs])
+            self._db.executemany(
+                "INSERT INTO dlqueue (cid, name, format, size, md5, target,"
+                "    priority) SELECT ?, ?, ?, ?, ?, ?, ?"
+                "  WHERE NOT EXISTS (SELECT 1 FROM dlqueue"
+                "    WHERE cid = ? AND name = ? AND target = ? AND state != ?)",
+                [(str(concert), song['name'], format, int(song['size']),
+                  song.get('md5'), target, priority) + key + (DL_DONE,)
+                 for (song, key) in zip(songlist, songs)])
+            self._db.commit()
+            self._changes += 1
+            self._cond.notify_all()
+
+    def pause(self, concert=None):
+        """Pause the given concert's songs (or all songs, if None).
+
+        Songs being downloaded are stopped; they'll resume from where
+        they left off."""
+        self._setState(concert, [DL_QUEUED], DL_PAUSED)
+        with self._cond:
+            for (qid, cid) in self._active.items():
+                if concert == None or cid == int(concert):
+                    self._halt.add(qid)
+
+    def resume(self, concert=None):
+        """Resume the given concert's paused or failed songs (or all)."""
+        self._setState(concert, [DL_PAUSED, DL_FAILED], DL_QUEUED)
+
+    def reprioritise(self, concert, priority):
+        """Change the priority of a concert's songs (higher goes first)."""
+        with self._cond:
+            self._db.execute("UPDATE dlqueue SET priority = ? WHERE cid = ?",
+                             (priority, str(concert)))
+            self._db.commit()
+
+    def status(self):
+        """Return what's in the queue, in the order it'll be downloaded.
+
+        Returns a list of (concert id, name, size, bytes done, state)
+        tuples."""
+        with self._cond:
+            c = self._db.cursor()
+            c.execute("SELECT qid, cid, name, size, done, state FROM dlqueue"
+                      "  ORDER BY priority DESC, qid")
+            rows = c.fetchall()
+            c.close()
+            return [(cid, name, size, self._done.get(qid, done), state)
+                    for (qid, cid, name, size, done, state) in rows]
+
+    def stop(self):
+        """Shut down the workers.
+
+        Songs being downloaded go back in the queue for next time."""
+        with self._cond:
+            self._stopped = True
+            self._halt.update(self._active)
+            self._cond.notify_all()
+        self._limiter.cancel()
+        for t in self._threads:
+            t.join()
+        self._db.close()
+
+    def _setState(self, concert, old, new):
+        """Move queued songs from one of the old states to the new."""
+        query = ("UPDATE dlqueue SET state = ? WHERE state IN (%s)" %
+                 ",".join(["?"] * len(old)))
+        params = [new] + old
+        if concert != None:
+            query += " AND cid = ?"
+            params.append(str(concert))
+        with self._cond:
+            self._db.execute(query, params)
+            self._db.commit()
+            self._changes += 1
+            self._cond.notify_all()
+
+    #
+    # the workers
+    #
+    # (the workers never touch the database while holding the condition,
+    # since that may mean waiting for a transaction of the thread that
+    # owns the manager, which may be waiting for the condition itself)
+    def _retry(self, db, action, *args):
+        """Run a database action for a worker, trying again, less and
+        less often, for as long as the database is locked.
+
+        Returns the action's result, or None if the manager's stopped
+        meanwhile."""
+        delay = DB_RETRY
+        while True:
+            try:
+                return action(*args)
+            except sqlite3.OperationalError:
+                # locked (by a long transaction elsewhere); try again
+                db.rollback()
+            with self._cond:
+                if self._stopped:
+                    return None
+                self._cond.wait(delay)
+            delay = min(delay * 2, DB_RETRY_MAX)
+
+    def _claimNext(self, db):
+        """Mark the next queued song active, and return it (or None)."""
+        with self._claim:
+            while True:
+                row = db.execute(
+                    "SELECT qid, cid, name, size, md5, target FROM dlqueue"
+                    "  WHERE state = ? ORDER BY priority DESC, qid LIMIT 1",
+                    (DL_QUEUED,)).fetchone()
+                if row == None:
+                    return None
+                # (it counts as active first, so pause() can halt it)
+                with self._cond:
+                    self._active[row[0]] = row[1]
+                claimed = False
+                try:
+                    claimed = db.execute(
+                        "UPDATE dlqueue SET state = ? WHERE qid = ?"
+                        "  AND state = ?", (DL_ACTIVE, row[0],
+                                            DL_QUEUED)).rowcount == 1
+                    db.commit()
+                finally:
+                    if not claimed:
+                        with self._cond:
+                            del self._active[row[0]]
+                            self._halt.discard(row[0])
+                if claimed:
+                    return row
+                # (paused or the like meanwhile; find another)
+
+    def _next(self, db):
+        """Claim the next song in the queue, waiting till there is one.
+
+        Returns None once the manager's stopped."""
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return None
+                changes = self._changes
+            row = self._retry(db, self._claimNext, db)
+            if row != None:
+                return row
+            with self._cond:
+                while self._changes == changes and not self._stopped:
+                    self._cond.wait()
+
+    def _checkpoint(self, db, qid, done):
+        """Save how far a song has got, unless the database is busy.
+
+        (The download doesn't wait for it; there'll be another chance.)"""
+        try:
+            db.execute("PRAGMA busy_timeout = 0")
+            db.execute("UPDATE dlqueue SET done = ? WHERE qid = ?",
+                       (done, qid))
+            db.commit()
+        except sqlite3.OperationalError:
+            db.rollback()
+        db.execute("PRAGMA busy_timeout = %d" % (DB_TIMEOUT * 1000))
+
+    def _record(self, db, qid, cid, state, done):
+        """Write a finished song's state (and its concert's, if that was
+        the last one).  Can safely be run again if it fails part way."""
+        db.execute("UPDATE dlqueue SET state = ?, done = ? WHERE qid = ?",
+                   (state, done, qid))
+        if state == DL_DONE:
+            # was that the last one for this concert?
+            left = db.execute("SELECT COUNT(*) FROM dlqueue"
+                              "  WHERE cid = ? AND state != ?",
+                              (cid, DL_DONE)).fetchone()[0]
+            if left == 0:
+                lma.Concert(db, cid).markDownloaded()
+                db.execute("DELETE FROM dlqueue WHERE cid = ?", (cid,))
+        db.commit()
+
+    def _finish(self, db, qid, cid, size, ok):
+        """Record how a song's download went."""
+        with self._cond:
+            halted = qid in self._halt
+            done = self._done.get(qid, 0)
+            if ok:
+                (state, done) = (DL_DONE, size)
+            elif not halted:
+                state = DL_FAILED
+            elif self._stopped:
+                state = DL_QUEUED
+            else:
+                state = DL_PAUSED
+        # (if the manager's stopped before this gets written, the song
+        # is still active in the queue, and starts again next time)
+        self._retry(db, self._record, db, qid, cid, state, done)
+        with self._cond:
+            self._halt.discard(qid)
+            del self._active[qid]
+            self._done.pop(qid, None)
+
+    def _work(self):
+        """Worker thread: download queued songs."""
+        db = lma.ArDb(self._dbpath, DB_TIMEOUT)
+        try:
+            while True:
+                row = self._next(db)
+                if row == None:
+                    return
+                (qid, cid, name, size, md5, target) = row
+                song = {"name" : name, "size" : size, "md5" : md5}
+                concert = lma.Concert(db, cid)
+                path = lma.download.song_path(target, song)
+                ok = False
+                try:
+                    verified = self._retry(db, concert.isVerified, path, md5)
+                    ok = lma.download.download_one_file(
+                        concert, song, target, _QueueProgress(self, db, qid),
+                        self._limiter, self.segments, verified, self.store)
+                    if ok:
+                        self._retry(db, concert.recordVerified, path, md5)
+                        if self.post != None:
+                            self.post.submit(path)
+                except (IOError, OSError, httplib.HTTPException):
+                    # the archive or the disk let us down; it's marked as
+                    # failed, and can be resumed later
+                    pass
+                finally:
+                    self._finish(db, qid, cid, size, ok)
+        finally:
+            db.close()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# Part of the Live Music Archive access library (lma)
+#
+# This library is copyright 2012 by Chris Waters.
+# It is licensed under a liberal MIT/X11 style license;
+# see the file "LICENSE" in this directory for details.
+
+"""Keep track of the songs we've downloaded.
+
+The libfile table records the checksum of each file we've checked,
+along with its size and modification time when we checked it.  As long
+as those haven't changed, the file can be trusted without reading it
+all back in.
+
+The scan_library() function finds the concerts already downloaded, by
+matching folder names to the concerts' identifiers, and checks their
+files, so the database knows about songs downloaded some other way (or
+before it was made).  The scrub_library() function reads them all
+back, to catch any that have gone bad since."""
+
+import os
+import time
+import hashlib
+import multiprocessing
+
+import lma
+import lma.details
+import lma.download
+import lma.postprocess
+
+# leftovers from downloads still in progress; not songs (yet)
+_PARTIAL_EXTS = (".part", ".part.pos", ".part.segs")
+
+def _stat(path):
+    """Return the size and modification time of a file, or None."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+def is_verified(db, path, md5):
+    """Return True if the file was checked and found to have this md5.
+
+    (And hasn't been changed since.)"""
+    path = os.path.abspath(path)
+    c = db.cursor()
+    c.execute("SELECT size, mtime, md5 FROM libfile WHERE path = ?",
+              (path,))
+    row = c.fetchone()
+    c.close()
+    if row == None or row[2] != md5:
+        return False
+    return _stat(path) == (row[0], row[1])
+
+def record_verified(db, path, md5, cid=None):
+    """Record that a file has been checked, and has this md5."""
+    path = os.path.abspath(path)
+    stat = _stat(path)
+    if stat == None:
+        return
+    c = db.cursor()
+    c.execute("INSERT OR REPLACE INTO libfile (path, cid, size, mtime, md5)"
+              "  VALUES (?, ?, ?, ?, ?)", (path, cid) + stat + (md5,))
+    c.close()
+    db.commit()
+
+#
+# scanning the library
+#
+
+# worker processes share this, to limit how many read at once
+_readers = None
+
+def _init_readers(readers):
+    """Set up a worker process with the shared read limit."""
+    global _readers
+    _readers = readers
+
+def _read(handle):
+    """Read the next block of a file, waiting our turn if need be."""
+    if _readers == None:
+        return handle.read(1024 * 1024)
+    with _readers:
+        return handle.read(1024 * 1024)
+
+def _hash_path(path):
+    """Return the path and the file's md5.  (Runs in a worker process.)
+
+    The md5 is None if the file can't be read."""
+    chksum = hashlib.md5()
+    try:
+        handle = open(path, "rb")
+        try:
+            data = _read(handle)
+            while len(data) > 0:
+                chksum.update(data)
+                data = _read(handle)
+        finally:
+            handle.close()
+    except (IOError, OSError):
+        return (path, None)
+    return (path, chksum.hexdigest())
+
+def _roots(roots):
+    """Return the directories to look in (the download dirs by default)."""
+    if roots == None:
+        cfg = lma.Config()
+        roots = [cfg.download_path, cfg.lossless_path]
+    roots = sorted(set([os.path.abspath(os.path.expanduser(root))
+                        for root in roots]))
+    return [root for root in roots if os.path.isdir(root)]
+
+def _find_concerts(db, roots):
+    """Find the concert folders under the given directories.
+
+    Returns a dict of folder : concert id."""
+    c = db.cursor()
+    c.execute("SELECT lmaid, cid FROM concert")
+    lmaids = dict(c.fetchall())
+    c.close()
+    found = {}
+    for root in roots:
+        for (dirpath, dirs, files) in os.walk(root):
+            cid = lmaids.get(os.path.basename(dirpath))
+            if cid != None:
+                found[dirpath] = cid
+                # anything below is part of the concert
+                dirs[:] = []
+    return found
+
+def _folder_files(folder):
+    """Return the files in a concert folder, as a dict of path : stat."""
+    found = {}
+    for (subdir, subdirs, names) in os.walk(folder):
+        for name in names:
+            if name.endswith(_PARTIAL_EXTS):
+                continue
+            path = os.path.join(subdir, name)
+            stat = _stat(path)
+            if stat != None:
+                found[path] = stat
+    return found
+
+def _hash_all(todo, callback, processes, readers=None):
+    """Hash the files in a pool of worker processes.
+
+    Yields (path, md5) pairs as they're done, stopping if the callback
+    cancels.  At most 'readers' workers read at once, if given."""
+    if len(todo) == 0:
+        return
+    gate = None
+    if readers:
+        gate = multiprocessing.Semaphore(readers)
+    pool = multiprocessing.Pool(processes, _init_readers, (gate,))
+    try:
+        results = pool.imap_unordered(_hash_path, todo, 4)
+        for (done, result) in enumerate(results, 1):
+            yield result
+            if not callback.update(done, len(todo)):
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+
+def scan_library(db, roots=None, progbar=lma.NullProgressBar,
+                 msg="Scan Downloaded Concerts", processes=None):
+    """Find the concerts already downloaded, and check their files.
+
+    Looks in the download directories (or the given list of roots) for
+    folders named after concerts, and marks those concerts downloaded.
+    Their files are hashed and recorded in the libfile table, but only
+    those that are new or have changed size or mtime since last time,
+    so rescanning a big library is mostly just a walk of the
+    directories.  The hashing is done by a pool of 'processes' worker
+    processes (by default, one per CPU).  Progress goes through a
+    ProgressCallback using progbar, which may cancel the scan; what's
+    been hashed so far is kept.
+
+    Returns the number of concert folders found and of files hashed."""
+    roots = _roots(roots)
+    folders = _find_concerts(db, roots)
+    found = {}
+    for (folder, cid) in folders.items():
+        for (path, stat) in _folder_files(folder).items():
+            found[path] = (cid,) + stat
+
+    c = db.cursor()
+    c.execute("SELECT path, size, mtime FROM libfile")
+    known = {}
+    for (path, size, mtime) in c.fetchall():
+        known[path] = (size, mtime)
+
+    # forget anything under the roots that's gone
+    gone = [(path,) for path in known if not path in found and
+            [root for root in roots if path.startswith(root + os.sep)]]
+    c.executemany("DELETE FROM libfile WHERE path = ?", gone)
+    # and mark the concerts we found
+    concerts = set(folders.values())
+    c.executemany("INSERT OR IGNORE INTO dlconcert (cid, dldate)"
+                  "  VALUES (?, date('now'))", [(cid,) for cid in concerts])
+    db.commit()
+
+    todo = [path for (path, (cid, size, mtime)) in found.items()
+            if known.get(path) != (size, mtime)]
+    callback = lma.ProgressCallback("Live Music Archive Library", msg,
+                                    progbar, frequency=1, can_cancel=True)
+    callback.start()
+    rows = []
+    try:
+        for (path, md5) in _hash_all(todo, callback, processes):
+            if md5 != None:
+                rows.append((path,) + found[path] + (md5,))
+    finally:
+        c.executemany("INSERT OR REPLACE INTO libfile"
+                      "  (path, cid, size, mtime, md5) VALUES (?, ?, ?, ?, ?)",
+                      rows)
+        c.close()
+        db.commit()
+        callback.end()
+    return (len(concerts), len(rows))
+
+#
+# scrubbing the library
+#
+
+# how many results to save up between checkpoints
+SCRUB_CHECKPOINT = 50
+
+def _scrub_started(db, restart):
+    """Return when the scrub in progress started, starting one if need be."""
+    c = db.cursor()
+    c.execute("SELECT scrub_started FROM lma_config WHERE recnum = 1")
+    started = c.fetchone()[0]
+    if started == None or restart:
+        started = time.time()
+        c.execute("UPDATE lma_config SET scrub_started = ? WHERE recnum = 1",
+                  (started,))
+        db.commit()
+    c.close()
+    return started
+
+def scrub_library(db, roots=None, progbar=lma.NullProgressBar,
+                  msg="Check Downloaded Files", processes=None,
+                  readers=None, restart=False, store=None):
+    """Check downloaded files against the archive's sizes and checksums.
+
+    Unlike scan_library(), every file is read again, so this finds
+    files that have gone bad without being touched.  Only concerts with
+    a cached file list can be checked, and only against the formats
+    that are there (having the mp3s and not the flacs isn't an error).
+    The hashing is done by a pool of 'processes' worker processes, at
+    most 'readers' of which read at once (Config.scrub_readers by
+    default; 0 for no limit).
+
+    Results are saved in the libfile table as they come in, so if the
+    scrub's cancelled, or the program dies, the next call picks up
+    where it left off.  Pass restart=True to start over anyway.
+
+    If a ContentStore is given, damaged files are dropped from it, so
+    they aren't linked into any more concerts.
+
+    Returns None if cancelled.  Otherwise returns a dict of lists of
+    (concert id, folder, name) tuples: 'mismatched' for files with the
+    wrong size or checksum, 'missing' for files that aren't there, and
+    'extra' for files the archive doesn't list (other than those the
+    post-processors made from songs it does)."""
+    if readers == None:
+        readers = lma.Config().scrub_readers
+    roots = _roots(roots)
+    started = _scrub_started(db, restart)
+    report = {"mismatched" : [], "missing" : [], "extra" : []}
+    # path : (concert id, folder, name, size, mtime, md5), to hash
+    todo = {}
+    expected = {} # path : md5, for everything listed
+
+    c = db.cursor()
+    for (folder, cid) in _find_concerts(db, roots).items():
+        c.execute("SELECT name, format, size, md5 FROM files WHERE cid = ?",
+                  (cid,))
+        listed = {}
+        for (name, format, size, md5) in c.fetchall():
+            listed[os.path.join(folder, os.path.normpath(name))] = (
+                name, format, size, md5)
+        if len(listed) == 0:
+            # no file list; nothing to check against
+            continue
+        local = _folder_files(folder)
+        formats = set([listed[path][1] for path in local if path in listed])
+        for (path, (name, format, size, md5)) in listed.items():
+            expected[path] = md5
+            if not path in local:
+                if format in formats:
+                    report["missing"].append((cid, folder, name))
+            elif size != None and local[path][0] != int(size):
+                report["mismatched"].append((cid, folder, name))
+            elif md5 != None:
+                todo[path] = (cid, folder, name) + local[path] + (md5,)
+        # (files made from the songs after download aren't strays)
+        songs = set([path.lower() for path in listed])
+        for path in local:
+            sources = lma.postprocess.made_from(path)
+            if (not path in listed and
+                not [src for src in sources if src.lower() in songs]):
+                name = os.path.relpath(path, folder).replace(os.sep, "/")
+                report["extra"].append((cid, folder, name))
+
+    # anything already done in this scrub (and not changed since) stays
+    c.execute("SELECT path, size, mtime, md5 FROM libfile"
+              "  WHERE scrubbed >= ?", (started,))
+    for (path, size, mtime, md5) in c.fetchall():
+        job = todo.get(path)
+        if job != None and job[3:5] == (size, mtime):
+            del todo[path]
+            if md5 != job[5]:
+                report["mismatched"].append(job[:3])
+
+    callback = lma.ProgressCallback("Live Music Archive Library", msg,
+                                    progbar, frequency=1, can_cancel=True)
+    callback.start()
+    rows = []
+    count = 0
+    try:
+        for (path, md5) in _hash_all(todo.keys(), callback, processes,
+                                     readers):
+            job = todo[path]
+            count += 1
+            if md5 != job[5]:
+                report["mismatched"].append(job[:3])
+            if md5 != None:
+                rows.append((path, job[0]) + job[3:5] + (md5, time.time()))
+            if len(rows) >= SCRUB_CHECKPOINT:
+                c.executemany("INSERT OR REPLACE INTO libfile"
+                              "  (path, cid, size, mtime, md5, scrubbed)"
+                              "  VALUES (?, ?, ?, ?, ?, ?)", rows)
+                db.commit()
+                rows = []
+    finally:
+        c.executemany("INSERT OR REPLACE INTO libfile"
+                      "  (path, cid, size, mtime, md5, scrubbed)"
+                      "  VALUES (?, ?, ?, ?, ?, ?)", rows)
+        db.commit()
+        callback.end()
+    if count < len(todo):
+        # cancelled; pick up from here next time
+        c.close()
+        return None
+    c.execute("UPDATE lma_config SET scrub_started = NULL WHERE recnum = 1")
+    c.close()
+    db.commit()
+    for v in report.values():
+        v.sort()
+    if store != None:
+        for (cid, folder, name) in report["mismatched"]:
+            path = os.path.join(folder, os.path.normpath(name))
+            store.discard(expected[path], path)
+    return report
+
+def requeue_damaged(db, report, manager):
+    """Queue the bad and missing files in a scrub report for download.
+
+    The songs go in the given DownloadManager's queue, and are fetched
+    with its settings (segments, store) at the time, so set those
+    first.  Returns how many were queued."""
+    songs = {}
+    for (cid, folder, name) in report["mismatched"] + report["missing"]:
+        songs.setdefault((cid, folder), set()).add(name)
+    queued = 0
+    for ((cid, folder), names) in sorted(songs.items()):
+        concert = lma.Concert(db, cid)
+        files = lma.details.load_filelist(db.cursor(), cid) or []
+        songlist = [f for f in files
+                    if f['name'] in names and f.get('size') != None]
+        if manager.store != None:
+            # (a damaged song may be the stored copy; don't link it back)
+            for f in songlist:
+                manager.store.discard(f.get('md5'),
+                                      lma.download.song_path(folder, f))
+        if len(songlist) > 0:
+            manager.enqueue(songlist, concert, os.path.dirname(folder))
+            queued += len(songlist)
+    return queued
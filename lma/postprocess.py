@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# Part of the Live Music Archive access library (lma)
+#
+# This library is copyright 2012 by Chris Waters.
+# It is licensed under a liberal MIT/X11 style license;
+# see the file "LICENSE" in this directory for details.
+
+"""Process songs once they've been downloaded.
+
+A Pipeline runs a chain of processors over each song it's given, in a
+pool of worker processes, so one concert's songs can be converted while
+the next are still downloading.  Each song is a job of its own: if a
+processor fails, that job is marked failed and the others carry on.
+
+Processors are classes, registered by name in PROCESSORS.  Each has an
+accepts(path) method, saying whether it wants the file, and a
+run(path, progress) method, which does the work, calls progress() with
+the fraction done now and then, and returns the path of its result
+(which is what the next processor in the chain gets).  A processor that
+can't do its job raises an exception, usually IOError.  If it makes new
+files, its source(path) method says what a file of its could have been
+made from, so they aren't taken for strays.
+
+The 'null' processor just reads the song through, for trying out the
+pipeline with no codecs installed; 'fail' does the same, then fails."""
+
+import os
+import time
+import threading
+import subprocess
+import multiprocessing
+import Queue
+from distutils.spawn import find_executable
+
+import lma
+
+# states for the jobs
+PP_QUEUED = "queued"
+PP_ACTIVE = "active"
+PP_DONE = "done"
+PP_FAILED = "failed"
+
+PROGRESS_INTERVAL = 0.1 # most often a job reports progress (seconds)
+
+#
+# the processors
+#
+class Processor(object):
+    """Base class for processors: takes any file, and leaves it be."""
+    name = None
+    def accepts(self, path):
+        return True
+    def run(self, path, progress):
+        return path
+    def source(self, path):
+        return None
+
+class NullProcessor(Processor):
+    """Reads the song through, and leaves it be."""
+    name = "null"
+    fail = False
+    def run(self, path, progress):
+        size = max(1, os.path.getsize(path))
+        done = 0
+        handle = open(path, "rb")
+        try:
+            data = handle.read(65536)
+            while len(data) > 0:
+                done += len(data)
+                progress(float(done) / size)
+                data = handle.read(65536)
+        finally:
+            handle.close()
+        if self.fail:
+            raise IOError("Failed on purpose: %s" % path)
+        return path
+
+class FailProcessor(NullProcessor):
+    """Reads the song through, then fails."""
+    name = "fail"
+    fail = True
+
+class ShnToFlac(Processor):
+    """Converts Shorten (.shn) files to FLAC, using ffmpeg.
+
+    The .flac goes alongside the .shn, which is kept, so the concert
+    still matches the archive's file list."""
+    name = "shn_to_flac"
+    def accepts(self, path):
+        return path.lower().endswith(".shn")
+    def source(self, path):
+        if path.lower().endswith(".flac"):
+            return os.path.splitext(path)[0] + ".shn"
+        return None
+    def run(self, path, progress):
+        target = os.path.splitext(path)[0] + ".flac"
+        if os.path.exists(target):
+            # done last time
+            return target
+        ffmpeg = find_executable("ffmpeg")
+        if ffmpeg == None:
+            raise IOError("Can't convert %s: no ffmpeg" % path)
+        # (made under another name, so a half-done file isn't mistaken
+        # for a good one)
+        partname = target + ".part"
+        proc = subprocess.Popen([ffmpeg, "-v", "error", "-y", "-i", path,
+                                 "-f", "flac", partname],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        if proc.returncode != 0:
+            if os.path.exists(partname):
+                os.remove(partname)
+            raise IOError("Can't convert %s: %s" % (path, err.strip()))
+        os.rename(partname, target)
+        progress(1.0)
+        return target
+
+PROCESSORS = dict([(p.name, p)
+                   for p in (NullProcessor, FailProcessor, ShnToFlac)])
+
+def made_from(path):
+    """Return the files a processor could have made this one from."""
+    sources = [p().source(path) for p in PROCESSORS.values()]
+    return [source for source in sources if source != None]
+
+def configured_processors():
+    """Return the names of the processors the configuration asks for."""
+    names = []
+    if lma.Config().shn_to_flac:
+        names.append(ShnToFlac.name)
+    return names
+
+#
+# the workers
+#
+
+# worker processes send their progress back through this queue
+_progress = None
+
+def _init_worker(queue):
+    """Set up a worker process with the progress queue."""
+    global _progress
+    _progress = queue
+
+def _run_job(jobid, names, path):
+    """Run the named processors over a song.  (Runs in a worker process.)
+
+    Returns the job id, the final path and an error message (or None)."""
+    last = [0]
+    def progress(step, fraction):
+        # (not too often; the queue isn't free)
+        now = time.time()
+        if now - last[0] >= PROGRESS_INTERVAL or fraction >= 1:
+            last[0] = now
+            _progress.put((jobid, (step + min(fraction, 1.0)) / len(names)))
+    try:
+        _progress.put((jobid, 0.0))
+        for (step, name) in enumerate(names):
+            processor = PROCESSORS[name]()
+            if processor.accepts(path):
+                path = processor.run(path,
+                                     lambda f, step=step: progress(step, f))
+    except Exception as e:
+        return (jobid, path, "%s: %s" % (type(e).__name__, e))
+    return (jobid, path, None)
+
+class Pipeline(object):
+    """Runs processors over songs, in a pool of worker processes.
+
+    The processors to use are named in the 'names' attribute (by
+    default, those the configuration asks for); it can be changed at any
+    time, and each song gets the processors named when it was submitted.
+    Songs can be submitted from any thread."""
+
+    def __init__(self, names=None, processes=None):
+        """processes is the size of the pool (by default, one per CPU)."""
+        if names == None:
+            names = configured_processors()
+        self.names = list(names)
+        self._lock = threading.Lock()
+        self._jobs = {} # job id -> [path, state, fraction, result, error]
+        self._nextid = 0
+        self._queue = multiprocessing.Queue()
+        self._pool = multiprocessing.Pool(processes, _init_worker,
+                                          (self._queue,))
+
+    def submit(self, path):
+        """Queue a song to be processed, and return its job id.
+
+        Returns None if there are no processors to run."""
+        names = list(self.names)
+        for name in names:
+            if not name in PROCESSORS:
+                raise ValueError("No such processor: %s" % name)
+        if len(names) == 0:
+            return None
+        with self._lock:
+            jobid = self._nextid
+            self._nextid += 1
+            self._jobs[jobid] = [path, PP_QUEUED, 0.0, None, None]
+        self._pool.apply_async(_run_job, (jobid, names, path),
+                               callback=self._finished)
+        return jobid
+
+    def _finished(self, result):
+        """Record how a job went.  (Called from the pool's thread.)"""
+        (jobid, path, error) = result
+        with self._lock:
+            job = self._jobs.get(jobid)
+            if job == None:
+                # cleared already
+                return
+            if error == None:
+                job[1:] = [PP_DONE, 1.0, path, None]
+            else:
+                job[1:] = [PP_FAILED, job[2], path, error]
+
+    def status(self):
+        """Return how the jobs are going, oldest first.
+
+        Returns a list of (job id, path, state, fraction done, result
+        path, error message) tuples.  The result path is the processed
+        song, once it's done."""
+        with self._lock:
+            while True:
+                try:
+                    (jobid, fraction) = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                job = self._jobs.get(jobid)
+                if job != None and job[1] in (PP_QUEUED, PP_ACTIVE):
+                    job[1:3] = [PP_ACTIVE, fraction]
+            return [(jobid,) + tuple(job)
+                    for (jobid, job) in sorted(self._jobs.items())]
+
+    def clear(self):
+        """Forget the jobs that are done or failed."""
+        with self._lock:
+            for (jobid, job) in self._jobs.items():
+                if job[1] in (PP_DONE, PP_FAILED):
+                    del self._jobs[jobid]
+
+    def close(self, wait=True):
+        """Shut down the workers.
+
+        If wait is true, the jobs already submitted are finished first;
+        otherwise they're abandoned."""
+        if wait:
+            self._pool.close()
+        else:
+            self._pool.terminate()
+        self._pool.join()
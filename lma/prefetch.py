@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# Part of the Live Music Archive access library (lma)
+#
+# This library is copyright 2012 by Chris Waters.
+# It is licensed under a liberal MIT/X11 style license;
+# see the file "LICENSE" in this directory for details.
+
+"""Fetch concert details and file lists in the background.
+
+While the user browses a concert list, the Prefetcher warms the cache
+for the concerts they're likely to open next, so opening one doesn't
+have to wait for the network.
+
+The harvest_details() function fetches everything for a whole list of
+concerts at once, so they can be browsed offline."""
+
+import threading
+import collections
+import Queue
+
+import lma
+import lma.details
+
+class Prefetcher(object):
+    """Background cache warmer for concert details and file lists.
+
+    A small pool of worker threads, each with its own database handle,
+    takes concerts from a bounded queue of pending requests.  Each call
+    to request() replaces the whole queue, so navigating somewhere else
+    cancels whatever hadn't started yet.  Fetches already under way are
+    allowed to finish, since they'll be cached either way."""
+
+    def __init__(self, dbpath, workers=2, max_pending=16):
+        """dbpath is the path to the database file."""
+        self._dbpath = dbpath
+        self._max_pending = max_pending
+        self._cond = threading.Condition()
+        self._pending = collections.deque()
+        self._active = set()
+        self._stopped = False
+        for i in xrange(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def request(self, concerts):
+        """Replace the pending requests with the given concerts.
+
+        Concerts are fetched in the order given, and anything beyond the
+        cap on pending requests is dropped."""
+        with self._cond:
+            self._pending.clear()
+            for concert in concerts:
+                if len(self._pending) >= self._max_pending:
+                    break
+                cid = int(concert)
+                if cid not in self._active and cid not in self._pending:
+                    self._pending.append(cid)
+            self._cond.notify_all()
+
+    def requestAround(self, concerts, row, top=None, count=0, radius=3):
+        """Request the concerts most likely to be opened next.
+
+        That means the selected row and its neighbours (nearest first),
+        then the rest of the visible window, if its first row ('top')
+        and number of rows ('count') are given."""
+        total = len(concerts)
+        rows = [row]
+        for i in xrange(1, radius + 1):
+            rows.extend([row + i, row - i])
+        if top != None:
+            rows.extend(xrange(top, top + count))
+        wanted = []
+        for i in rows:
+            if 0 <= i < total and i not in wanted:
+                wanted.append(i)
+        self.request([concerts[i] for i in wanted[:self._max_pending]])
+
+    def cancel(self):
+        """Drop all pending requests."""
+        self.request([])
+
+    def stop(self):
+        """Drop all pending requests and shut down the workers."""
+        with self._cond:
+            self._stopped = True
+            self._pending.clear()
+            self._cond.notify_all()
+
+    def _work(self):
+        """Worker thread: fetch and cache pending concerts."""
+        db = lma.ArDb(self._dbpath)
+        try:
+            while True:
+                with self._cond:
+                    while not self._pending and not self._stopped:
+                        self._cond.wait()
+                    if self._stopped:
+                        return
+                    cid = self._pending.popleft()
+                    self._active.add(cid)
+                try:
+                    c = db.cursor()
+                    cached = lma.details.is_cached(c, cid)
+                    c.close()
+                    if not cached:
+                        lma.details.load_item(db, lma.Concert(db, cid))
+                except Exception:
+                    # this is just a hint; the concert will be fetched
+                    # again (and any error reported) if it's opened.
+                    pass
+                finally:
+                    with self._cond:
+                        self._active.discard(cid)
+        finally:
+            db.close()
+
+def _store_batch(db, batch):
+    """Write a batch of harvested concerts to the cache. (Internal)"""
+    if len(batch) == 0:
+        return
+    c = db.cursor()
+    for (cid, lmaid, (meta, files)) in batch:
+        lma.details.store_item(c, cid, lmaid, meta, files)
+    c.close()
+    db.commit()
+
+def harvest_details(db, concerts, progbar=lma.NullProgressBar,
+                    msg="Retrieve Concert Details", workers=4, batch=20):
+    """Fetch and cache the details and file lists for many concerts.
+
+    Concerts already cached are skipped, so an interrupted harvest can
+    simply be run again to pick up where it left off.  Up to 'workers'
+    concerts are fetched (and parsed) at once, by worker threads; the
+    results are written to the database in this thread, 'batch'
+    concerts per transaction.  Progress goes through a ProgressCallback
+    using progbar, which may cancel the harvest.
+
+    Returns the number of concerts which couldn't be fetched."""
+
+    # find out what still needs fetching
+    c = db.cursor()
+    todo = [(int(x), x.lmaid) for x in concerts
+            if not lma.details.is_cached(c, x)]
+    c.close()
+
+    callback = lma.ProgressCallback("Live Music Archive Download", msg,
+                                    progbar, frequency=1, can_cancel=True)
+    callback.start()
+
+    jobs = Queue.Queue()
+    for job in todo:
+        jobs.put(job)
+    results = Queue.Queue(workers * 2)
+    stop = threading.Event()
+
+    def work():
+        while not stop.is_set():
+            try:
+                (cid, lmaid) = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                data = lma.details.get_item_data(lmaid)
+            except Exception:
+                data = None
+            while not stop.is_set():
+                try:
+                    results.put((cid, lmaid, data), timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+
+    for i in xrange(min(workers, len(todo))):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+
+    failed = 0
+    pending = []
+    try:
+        for done in xrange(1, len(todo) + 1):
+            (cid, lmaid, data) = results.get()
+            if data == None:
+                failed += 1
+            else:
+                pending.append((cid, lmaid, data))
+            if len(pending) >= batch:
+                _store_batch(db, pending)
+                pending = []
+            if not callback.update(done, len(todo)):
+                break
+    finally:
+        stop.set()
+        _store_batch(db, pending)
+        callback.end()
+    return failed
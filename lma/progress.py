@@ -19,26 +19,31 @@ class NullProgressBar(object):
 
 class ProgressCallback(object):
     """Interface for hooking progress dialogs."""
-    def __init__(self, title, msg, bar=NullProgressBar, frequency = 100):
+    def __init__(self, title, msg, bar=NullProgressBar, frequency = 100,
+                 can_cancel=False):
         """Passed a class for creating a progress bar, plus update frequency"""
         self._title = title
         self._msg = msg
         self._bar = bar
         self._frequency = frequency
+        self._can_cancel = can_cancel
 
     def start(self):
         """Called when starting.  Creates the progress bar."""
-        self._dialog = self._bar(self._title, self._msg, 100)
+        self._dialog = self._bar(self._title, self._msg, 100,
+                                 can_cancel=self._can_cancel)
 
     def update(self, current, total):
-        """Called every 'frequency' records."""
+        """Called every 'frequency' records.
+
+        Returns False if the user cancelled."""
         if total == 0:
             # technically we're 100% done
             percent = 100
         else:
             assert current <= total
             percent = (current * 100.0) / total
-        self._dialog.update(percent)
+        return self._dialog.update(percent)
 
     def end(self):
         """Called when done reading records"""
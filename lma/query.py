@@ -10,10 +10,17 @@
 The Query class is used to construct queries, and will iterate through
 the results.
 
-The ProgressIter class allows hooking a UI callback into a Query."""
+The ProgressIter class allows hooking a UI callback into a Query.
+
+For bulk loading, Query.batches() returns the results a page at a time
+as lists of tuples, ready to hand straight to executemany().
+Query.pipeline() does the same, but downloads and decodes the following
+pages in background threads while the caller works on the current one."""
 
 import time
 import urllib2
+import threading
+import Queue
 
 # Hostname to access
 ARCHIVE_URL = "http://www.archive.org"
@@ -37,19 +44,25 @@ STANDARD_FIELDS=[IDENTIFIER, TITLE]
 # A sample version of the type of URL we'll be using to query the LMA is:
 # http://archive.org/advancedsearch.php?q=mediatype%3Acollection%20AND%20collection%3Aetree&fl[]=identifier&sort[]=&sort[]=&sort[]=&rows=50&page=1&output=json
 
-def archive_open(path, search=False):
+def archive_open(path, search=False, metadata=False, headers=None):
     """URL handler wrapper for Internet Archive addresses.
 
     Takes two arguments: a relative path (or search string) and a
     search flag, which defaults to false.  If the search flag set to
     True, this sends a query to the Archive's search engine,
-    otherwise, it opens a downloadable file."""
+    otherwise, it opens a downloadable file.  If the metadata flag is
+    set instead, the path is an item identifier, and this opens the
+    json document describing the item and its files.  Any extra HTTP
+    headers (a Range, say) can be passed as a dict."""
 
     if search:
         op = "/advancedsearch.php?"
+    elif metadata:
+        op = "/metadata/"
     else:
         op = "/download/"
-    return urllib2.urlopen(ARCHIVE_URL + op + path)
+    return urllib2.urlopen(urllib2.Request(ARCHIVE_URL + op + path,
+                                           headers=headers or {}))
 
 
 class _Result (object):
@@ -58,13 +71,14 @@ class _Result (object):
     Encapsulates the state of the query at the time it's created,
     and can then be used to iterate through the results."""
 
-    def __init__(self, query, field, sort, rows=50, date=None):
+    def __init__(self, query, field, sort, rows=50, date=None, after=None):
         self._query = query
         self._field = list(field)
         self._sort = list(sort)
         self._rows = rows
         self._date = date
-        self._page = 0
+        self._after = after
+        self._page = 1 # the Archive numbers pages from 1
         self._results = 0
         self._current = 0
         self._data = []
@@ -72,25 +86,30 @@ class _Result (object):
 
     def calc_query(self):
         """Calculate the full query including date restriction."""
+        if self._after != None:
+            # exclusive lower bound, no upper bound
+            return "%s AND publicdate:{%s TO *]" % (self._query, self._after)
         if self._date == None:
             return self._query
         today = time.strftime("%Y-%m-%d", time.gmtime())
         return "%s AND publicdate:[%s TO %s]" % (self._query, self._date, today)
 
-    def _make_json_url(self):
+    def _make_json_url(self, page=None):
         """Make the URL to use to get a page of json data.  (Internal)"""
+        if page == None:
+            page = self._page
         body = (["q=" + urllib2.quote(self.calc_query()),
                  "rows=" + str(self._rows),
-                 "page=" + str(self._page),
+                 "page=" + str(page),
                  "output=json"] +
                 ["fl[]=" + urllib2.quote(f) for f in self._field] +
                 ["sort[]=" + urllib2.quote(s) for s in self._sort])
         return "&".join(body)
 
-    def _read_page(self):
-        """Read the next page of data from the Archive. (Internal)"""
+    def _read_page(self, page=None):
+        """Read the next (or given) page of data from the Archive. (Internal)"""
         
-        hand = archive_open(self._make_json_url(), search=True)
+        hand = archive_open(self._make_json_url(page), search=True)
         try:
             data = hand.read()
         finally:
@@ -99,11 +118,7 @@ class _Result (object):
 
     def _refill_data(self):
         """Read and parse next page of data from the Archive. (Internal)"""
-        import json
-        j = json.loads(self._read_page())
-        response=j["response"]
-        self._results = response["numFound"]
-        self._data = response["docs"]
+        (self._results, self._data) = _parse_page(self._read_page())
 
     def _cleandata(self, n):
         """Make sure all fields are present in returned data.
@@ -142,6 +157,29 @@ class _Result (object):
         self._current += 1
         return self._cleandata(offset)
 
+    def next_page(self):
+        """Return all unread records from the current page, then advance.
+
+        The records are the decoded json docs, as sent by the Archive
+        (missing fields are not filled in)."""
+        offset = self._current % self._rows
+
+        if self._current >= self._results:
+            raise StopIteration
+
+        if offset == 0 and self._current > 0:
+            self._page += 1
+            self._refill_data()
+            if self._current >= self._results:
+                raise StopIteration
+
+        docs = self._data[offset:]
+        if len(docs) == 0:
+            # short page; the result set must have shrunk under us
+            raise StopIteration
+        self._current += len(docs)
+        return docs
+
     def __iter__(self):
         """Required for proper iterator-like behavior."""
         return self
@@ -154,6 +192,180 @@ class _Result (object):
         """Return total records (useful for UI callback functions)."""
         return self._results
 
+def _parse_page(data):
+    """Decode a page of json results into (total records, list of docs)."""
+    import json
+    response = json.loads(data)["response"]
+    return (response["numFound"], response["docs"])
+
+def docs_to_rows(docs, columns):
+    """Convert a list of json docs into a list of tuples of the columns.
+
+    Missing fields become empty strings, as with _Result._cleandata(),
+    but the docs themselves are left untouched."""
+    return [tuple([doc.get(k, u"") for k in columns]) for doc in docs]
+
+class _Batches(object):
+    """Iterate through query results a page at a time.
+
+    Each step returns a list of tuples holding the requested columns in
+    order, suitable for passing to executemany() with positional
+    parameters."""
+
+    def __init__(self, result, columns):
+        self._result = result
+        self._columns = list(columns)
+
+    def next(self):
+        """Return the next page of results as a list of tuples."""
+        return docs_to_rows(self._result.next_page(), self._columns)
+
+    def __iter__(self):
+        return self
+
+    def current(self):
+        """Return number of records read so far."""
+        return self._result.current()
+
+    def total(self):
+        """Return total records."""
+        return self._result.total()
+
+# marks the end of the data in a pipeline queue
+_END = object()
+
+class _PipelineError(object):
+    """Wraps an exception raised in a pipeline thread. (Internal)"""
+    def __init__(self, exc):
+        self.exc = exc
+
+class _Pipeline(object):
+    """Iterate through query results a page at a time, reading ahead.
+
+    Works like _Batches, but the pages after the first are downloaded
+    by one background thread and decoded by another, each feeding the
+    next stage through a small bounded queue.  So while the caller
+    (usually writing to the database) works on one page, the next is
+    being decoded and the one after that downloaded.  The queues limit
+    how far ahead the readers get.
+
+    The caller's stage runs in the caller's thread, since sqlite handles
+    and GUI progress dialogs generally can't be used from elsewhere.
+    Call cancel() to stop early; the background threads will notice and
+    exit as soon as their current network read finishes."""
+
+    def __init__(self, result, columns, depth=2, watermark=None):
+        self._result = result
+        self._columns = list(columns)
+        self._stop = threading.Event()
+        self._fetched = Queue.Queue(depth)
+        self._decoded = Queue.Queue(depth)
+        self._current = 0
+        self._markfield = watermark
+        self.watermark = None
+
+        # the first page has already been read to get the total
+        self._total = result.total()
+        self._first = self._convert((self._total, result._data))
+        rows = result._rows
+        self._pages = (self._total + rows - 1) // rows
+
+        for stage in [self._fetch, self._decode]:
+            t = threading.Thread(target=stage)
+            t.daemon = True
+            t.start()
+
+    def _put(self, queue, item):
+        """Put item on queue, giving up if we've been cancelled."""
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _convert(self, page):
+        """Turn a decoded page into rows, noting the page's highest
+        watermark value and the total the Archive gave with it."""
+        (total, docs) = page
+        if self._markfield == None:
+            return (docs_to_rows(docs, self._columns), None, total)
+        field = self._markfield
+        mark = max([doc.get(field, u"") for doc in docs] or [None])
+        return (docs_to_rows(docs, self._columns), mark, total)
+
+    def _get(self, queue):
+        """Get the next item from queue, or _END if we've been cancelled."""
+        while not self._stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        return _END
+
+    def _fetch(self):
+        """Stage 1: download the raw pages."""
+        try:
+            for page in xrange(2, self._pages + 1):
+                if not self._put(self._fetched, self._result._read_page(page)):
+                    return
+            item = _END
+        except Exception as e:
+            item = _PipelineError(e)
+        self._put(self._fetched, item)
+
+    def _decode(self):
+        """Stage 2: decode the pages and convert them to rows."""
+        while True:
+            item = self._get(self._fetched)
+            if item is not _END and not isinstance(item, _PipelineError):
+                try:
+                    item = self._convert(_parse_page(item))
+                except Exception as e:
+                    item = _PipelineError(e)
+            if not self._put(self._decoded, item):
+                return
+            if item is _END or isinstance(item, _PipelineError):
+                return
+
+    def next(self):
+        """Return the next page of results as a list of tuples."""
+        if self._first != None:
+            rows = self._first
+            self._first = None
+        else:
+            rows = self._get(self._decoded)
+        if rows is _END:
+            raise StopIteration
+        if isinstance(rows, _PipelineError):
+            self.cancel()
+            raise rows.exc
+        (rows, mark, total) = rows
+        if len(rows) == 0:
+            raise StopIteration
+        if mark and (self.watermark == None or mark > self.watermark):
+            self.watermark = mark
+        self._current += len(rows)
+        # (the total can change under us, if items are added meanwhile)
+        self._total = max(total, self._current)
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def cancel(self):
+        """Stop the background threads."""
+        self._stop.set()
+
+    def current(self):
+        """Return number of records read so far."""
+        return self._current
+
+    def total(self):
+        """Return total records."""
+        return self._total
+
 class Query (object):
     """Defines an Archive query.
 
@@ -174,6 +386,7 @@ class Query (object):
         self._sort = []
         self._rows = 50
         self._date = None
+        self._after = None
 
     def set_query(self, query):
         """Set main search string."""
@@ -188,10 +401,13 @@ class Query (object):
         for f in fields:
             self._field.append(str(f))
 
-    def add_sort(self, field):
+    def add_sort(self, field, descending=False):
         """Add to list of fields to sort by (max 3)."""
         if len(self._sort) < 3:
-            self._field.append(str(field))
+            if descending:
+                self._sort.append("%s desc" % field)
+            else:
+                self._sort.append("%s asc" % field)
         else:
             raise IndexError
 
@@ -206,39 +422,161 @@ class Query (object):
         """Define a limiting date for the query."""
         self._date = date
 
+    def published_after(self, stamp):
+        """Only find items published strictly after the given timestamp.
+
+        The timestamp is in the Archive's own format, as returned in the
+        publicdate field.  This overrides any newer_than() date."""
+        self._after = stamp
+
+    def _result(self, field):
+        """Create the results object for the given fields. (Internal)"""
+        return _Result(self._query, field, self._sort, self._rows,
+                       self._date, self._after)
+
     def __iter__(self):
         """Return iterator encapsulating current parameters."""
         field = self._field
         # set default value for returned field if none given
         if len(field) == 0:
             field = [IDENTIFIER]
-        return _Result(self._query, field, self._sort, self._rows, self._date)
+        return self._result(field)
+
+    def batches(self, columns=None):
+        """Return a page-at-a-time iterator over the query results.
+
+        Each page is a list of tuples of the given columns (which default
+        to the query's fields, and are requested from the Archive)."""
+        if columns == None:
+            columns = self._field or [IDENTIFIER]
+        return _Batches(self._result(columns), columns)
+
+    def pipeline(self, columns=None, depth=2, watermark=None):
+        """Like batches(), but reads ahead in background threads.
+
+        Up to 'depth' pages are held in each of the download and decode
+        queues.  The iterator has a cancel() method to stop early.
+
+        If a watermark field (e.g. PUBDATE) is given, it is also fetched,
+        and the highest value seen is kept in the iterator's 'watermark'
+        attribute."""
+        if columns == None:
+            columns = self._field or [IDENTIFIER]
+        fields = list(columns)
+        if watermark != None and watermark not in fields:
+            fields.append(watermark)
+        return _Pipeline(self._result(fields), columns, depth, watermark)
 
 class ProgressIter(object):
-    """Wrap an LMA query with a progress callback object."""
+    """Wrap an LMA query with a progress callback object.
+
+    If the progress bar is cancelled, iteration stops early, and the
+    'cancelled' attribute is set."""
     def __init__(self, query, callback):
         self._iter = iter(query)
         self._callback = callback
         self._count = 0
+        self._ended = False
+        self.cancelled = False
         callback.start()
 
+    def _end(self):
+        """Close the progress bar (once)."""
+        if not self._ended:
+            self._ended = True
+            self._callback.end()
+
     def next(self):
         """Iterate on the wrapped iterator."""
         try:
             value = self._iter.next()
         except:
-            self._callback.end()
+            self._end()
             raise
 
         if (self._count % self._callback.frequency) == 0:
-            self._callback.update(self._iter.current(), self._iter.total())
+            try:
+                ok = self._callback.update(self._iter.current(),
+                                           self._iter.total())
+            except:
+                self.cancel()
+                raise
+            if not ok:
+                self.cancelled = True
+                self.cancel()
+                raise StopIteration
         self._count += 1
         return value
 
     def __iter__(self):
         return self
 
+    def cancel(self):
+        """Stop the wrapped iterator (if it can be), and the callback.
+
+        Call this if the loop over the iterator is left early."""
+        if hasattr(self._iter, "cancel"):
+            self._iter.cancel()
+        self._end()
+
+class _FakeResult(_Result):
+    """Query result that serves synthetic pages instead of reading the
+    Archive, for benchmarking. (Internal)"""
+    def __init__(self, pages, *args):
+        self._pages = pages
+        super(_FakeResult, self).__init__(*args)
+    def _read_page(self, page=None):
+        if page == None:
+            page = self._page
+        return self._pages[page - 1]
+
+def _benchmark(records=100000, rows=500):
+    """Compare per-record dict loading with page-at-a-time tuple loading."""
+    import json
+    import sqlite3
+
+    fields = [TITLE, IDENTIFIER, YEAR, DATE]
+    # leave out the year now and then, so the filling-in gets exercised
+    docs = [{TITLE: u"Artist Live at Venue on 1990-01-%02d" % (i % 28 + 1),
+             IDENTIFIER: u"artist%07d" % i, DATE: u"1990-01-01T00:00:00Z"}
+            for i in xrange(records)]
+    for i, doc in enumerate(docs):
+        if i % 10:
+            doc[YEAR] = u"1990"
+    pages = [json.dumps({"response" : {"numFound" : records,
+                                       "docs" : docs[i:i + rows]}})
+             for i in xrange(0, records, rows)]
+
+    def makedb():
+        db = sqlite3.connect(":memory:")
+        db.execute("CREATE TABLE concert (ctitle, lmaid UNIQUE, cyear, cdate)")
+        return db
+
+    db = makedb()
+    start = time.time()
+    db.executemany("INSERT OR IGNORE INTO concert VALUES"
+                   "  (:title, :identifier, :year, date(:date))",
+                   _FakeResult(pages, "", fields, [], rows))
+    db.commit()
+    before = records / (time.time() - start)
+
+    db = makedb()
+    start = time.time()
+    for batch in _Batches(_FakeResult(pages, "", fields, [], rows), fields):
+        db.executemany("INSERT OR IGNORE INTO concert VALUES"
+                       "  (?, ?, ?, date(?))", batch)
+    db.commit()
+    after = records / (time.time() - start)
+
+    print("per-record dicts: %10.0f records/sec" % before)
+    print("page batches:     %10.0f records/sec" % after)
+
 if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ["bench"]:
+        _benchmark()
+        sys.exit(0)
+
     # grab two quick pages to see
     import pprint
     mypagesize = 10
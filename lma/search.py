@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# Part of the Live Music Archive access library (lma)
+#
+# This library is copyright 2012 by Chris Waters.
+# It is licensed under a liberal MIT/X11 style license;
+# see the file "LICENSE" in this directory for details.
+
+"""Full-text search of the locally cached concert data.
+
+This searches the details (description, notes, lineage, etc.) and song
+titles of every concert we've cached, across all artists.  It only
+finds what's in the cache; use ConcertList.makeOffline() to cache an
+artist's concerts first.
+
+Searches use SQLite's full-text query syntax, so for example
+'lineage:schoeps' or '"dark star"' work as expected."""
+
+import lma
+
+def search_details(db, text, limit=50):
+    """Find concerts whose cached details match the search text.
+
+    Returns a list of (Concert, score) pairs, best match first."""
+    c = db.cursor()
+    c.execute("SELECT docid, rank(matchinfo(details_fts, 'pcx')) AS score"
+              "  FROM details_fts WHERE details_fts MATCH ?"
+              "  ORDER BY score DESC LIMIT ?", (text, int(limit)))
+    result = [(lma.Concert(db, cid), score) for (cid, score) in c.fetchall()]
+    c.close()
+    return result
+
+def search_tracks(db, text, limit=50):
+    """Find cached songs whose titles match the search text.
+
+    Returns a list of (Concert, file name, title, score) tuples, best
+    match first."""
+    c = db.cursor()
+    c.execute("SELECT f.cid, f.name, f.title,"
+              "    rank(matchinfo(files_fts, 'pcx')) AS score"
+              "  FROM files_fts JOIN files AS f ON f.fid = files_fts.docid"
+              "  WHERE files_fts MATCH ?"
+              "  ORDER BY score DESC LIMIT ?", (text, int(limit)))
+    result = [(lma.Concert(db, cid), name, title, score)
+              for (cid, name, title, score) in c.fetchall()]
+    c.close()
+    return result
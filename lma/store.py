@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Part of the Live Music Archive access library (lma)
+#
+# This library is copyright 2012 by Chris Waters.
+# It is licensed under a liberal MIT/X11 style license;
+# see the file "LICENSE" in this directory for details.
+
+"""Keep one copy of each downloaded file, however many concerts have it.
+
+A ContentStore is a directory of files named by their md5.  The songs in
+the concert folders are hard links to them, so a song that turns up in
+several items (or in both the lossless and lossy folders) takes up the
+disk space, and the download, only once.
+
+Hard links only work within one filesystem, and not everywhere at that;
+when a link can't be made, the song is simply downloaded as usual."""
+
+import os
+import errno
+import hashlib
+
+import lma
+import lma.download
+
+# the store's directory, in the download directory
+STORE_DIR = ".lma-store"
+
+# (os.link is missing on some platforms)
+_link = getattr(os, "link", None)
+
+def _md5(path):
+    """Return the md5 of a file."""
+    chksum = hashlib.md5()
+    handle = open(path, "rb")
+    try:
+        lma.download._hash_file(handle, chksum)
+    finally:
+        handle.close()
+    return chksum.hexdigest()
+
+class ContentStore(object):
+    """A directory of files named by their md5."""
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+
+    def path(self, md5):
+        """Return where the file with this md5 is kept."""
+        md5 = md5.lower()
+        return os.path.join(self.root, md5[:2], md5)
+
+    def __contains__(self, md5):
+        return md5 != None and os.path.isfile(self.path(md5))
+
+    def fetch(self, md5, filename, size=None):
+        """Link the stored file with this md5 to the given name.
+
+        The stored file is checked first, since every concert linked to
+        it shares any damage; if it's gone bad (or isn't the given
+        size), it's dropped from the store.  Returns False if it isn't
+        stored, is bad, or the link can't be made."""
+        if md5 == None or _link == None:
+            return False
+        stored = self.path(md5)
+        try:
+            if not os.path.isfile(stored):
+                return False
+            if ((size != None and os.stat(stored).st_size != int(size)) or
+                _md5(stored) != md5.lower()):
+                os.remove(stored)
+                return False
+            _link(stored, filename)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def discard(self, md5, filename=None):
+        """Drop the stored file with this md5.
+
+        If a filename is given, only if that's a link to the stored file
+        (so a damaged song doesn't take a good stored copy with it)."""
+        if md5 == None:
+            return
+        stored = self.path(md5)
+        try:
+            if filename == None or os.path.samefile(stored, filename):
+                os.remove(stored)
+        except OSError:
+            pass
+
+    def add(self, md5, filename):
+        """Keep the given file, which has this md5, in the store.
+
+        Returns False if it can't be linked in.  If the store already
+        has the md5, the file is left as it is."""
+        if md5 == None or _link == None:
+            return False
+        stored = self.path(md5)
+        (head, tail) = os.path.split(stored)
+        if not os.path.isdir(head):
+            try:
+                os.makedirs(head)
+            except OSError:
+                # another thread may have beaten us to it
+                if not os.path.isdir(head):
+                    return False
+        try:
+            _link(filename, stored)
+        except OSError as e:
+            return e.errno == errno.EEXIST
+        return True
+
+    def prune(self):
+        """Remove stored files no concert folder links to any more.
+
+        Returns how many were removed."""
+        count = 0
+        for (dirpath, dirs, files) in os.walk(self.root):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        count += 1
+                except OSError:
+                    pass
+        return count
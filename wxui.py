@@ -24,6 +24,8 @@ This is intended in part as a demo of the underlying lma library, which
 I hope to use to build add-ons for standalone music systems like
 Gnome's Rhythmbox and KDE's Amarok.  But it works well enough for now."""
 
+import os
+
 import lma
 import wx
 
@@ -163,6 +165,20 @@ class MultiProgressDialog (wx.Dialog):
 #
 # Download dialog (for songs)
 #
+def download_segments():
+    """How many connections to use for each big song."""
+    if lma.Config().segmented_download:
+        return lma.download.SEGMENTS
+    return 1
+
+def download_store():
+    """Where to keep shared songs, or None."""
+    cfg = lma.Config()
+    if cfg.dedup_store:
+        return lma.ContentStore(os.path.join(
+            os.path.expanduser(cfg.download_path), lma.STORE_DIR))
+    return None
+
 class DownloadDialog(wx.Dialog):
     """Download songs.  Call run() method to use."""
     def __init__(self, parent, id, songs, concert):
@@ -222,12 +238,9 @@ class DownloadDialog(wx.Dialog):
         sizer.Add(check, 0, wx.LEFT, 5)
 
         # now the main songlist
-        names = [song['title'] for song in self._songs]
-        self._list = wx.CheckListBox(self, -1, choices=names)
+        self._list = wx.CheckListBox(self, -1)
         self.Bind(wx.EVT_CHECKLISTBOX, self.OnSongChecked, self._list)
-        # check them all by default
-        for i in range(len(self._songs)):
-            self._list.Check(i, True)
+        self.fillList()
 
         sizer.Add(self._list, 1, wx.ALL, 5)
 
@@ -238,9 +251,16 @@ class DownloadDialog(wx.Dialog):
         self.showTotal()
         self.SetSizer(sizer)
 
+    def fillList(self):
+        """List the songs in the current format, all checked."""
+        # (the sets needn't be the same length)
+        self._list.Set([song['title'] for song in self._songs])
+        for i in range(len(self._songs)):
+            self._list.Check(i, True)
+
     def showTotal(self):
         """Display total for current format."""
-        total = sum([int(song['size']) for i,song in enumerate(self._songs)
+        total = sum([song['size'] for i,song in enumerate(self._songs)
                     if self._list.IsChecked(i)])
         if total < 1e6:
             val = "%.2fk" % (total/1e3)
@@ -258,8 +278,19 @@ class DownloadDialog(wx.Dialog):
                 artist =self._concert.artist.name
             to_get = [song for i, song in enumerate(self._songs)
                       if self._list.IsChecked(i)]
+            wx.GetApp().postprocess.names = lma.configured_processors()
+            if lma.Config().background_download:
+                wx.GetApp().downloads.segments = download_segments()
+                wx.GetApp().downloads.store = download_store()
+                wx.GetApp().downloads.enqueue(to_get, self._concert,
+                                              self._dir.GetPath(), artist,
+                                              self._songs.current_format)
+                break
             if lma.download_files(to_get, self._concert, self._dir.GetPath(),
-                                  artist, MultiProgressDialog):
+                                  artist, MultiProgressDialog,
+                                  segments=download_segments(),
+                                  store=download_store(),
+                                  post=wx.GetApp().postprocess):
                 break
         self.Destroy()
 
@@ -269,9 +300,10 @@ class DownloadDialog(wx.Dialog):
         format = event.GetString()
         cfg = lma.Config()
         self._songs.current_format = format
+        self.fillList()
         self.showTotal()
         # change dir to match
-        if (format == self._songs.LosslessFormat()):
+        if self._songs.isLossless(format):
             if (self._dir.GetPath() == cfg.download_path):
                 self._dir.SetPath(cfg.lossless_path)
         elif (self._dir.GetPath() == cfg.lossless_path):
@@ -331,6 +363,56 @@ class ConfigurationDialog(wx.Dialog):
         tmpsizer.Add(check, 0)
         sizer.Add(tmpsizer, 0, wx.ALL, 5)
 
+        # fetch details with concert lists?
+        tmpsizer = wx.BoxSizer(wx.HORIZONTAL)
+        check = wx.CheckBox(self, -1,
+                            _(u"Fetch concert details with concert lists?"))
+        if cfg.harvest_details:
+            check.SetValue(True)
+        self.Bind(wx.EVT_CHECKBOX, self.OnHarvestCheck, check)
+        tmpsizer.Add(check, 0)
+        sizer.Add(tmpsizer, 0, wx.ALL, 5)
+
+        # download in the background?
+        tmpsizer = wx.BoxSizer(wx.HORIZONTAL)
+        check = wx.CheckBox(self, -1,
+                            _(u"Download songs in the background?"))
+        if cfg.background_download:
+            check.SetValue(True)
+        self.Bind(wx.EVT_CHECKBOX, self.OnBackgroundCheck, check)
+        tmpsizer.Add(check, 0)
+        sizer.Add(tmpsizer, 0, wx.ALL, 5)
+
+        # download big files in segments?
+        tmpsizer = wx.BoxSizer(wx.HORIZONTAL)
+        check = wx.CheckBox(self, -1,
+                            _(u"Download big songs over several connections?"))
+        if cfg.segmented_download:
+            check.SetValue(True)
+        self.Bind(wx.EVT_CHECKBOX, self.OnSegmentedCheck, check)
+        tmpsizer.Add(check, 0)
+        sizer.Add(tmpsizer, 0, wx.ALL, 5)
+
+        # share songs between concerts?
+        tmpsizer = wx.BoxSizer(wx.HORIZONTAL)
+        check = wx.CheckBox(self, -1,
+                            _(u"Keep one copy of songs shared by concerts?"))
+        if cfg.dedup_store:
+            check.SetValue(True)
+        self.Bind(wx.EVT_CHECKBOX, self.OnDedupCheck, check)
+        tmpsizer.Add(check, 0)
+        sizer.Add(tmpsizer, 0, wx.ALL, 5)
+
+        # convert shn files?
+        tmpsizer = wx.BoxSizer(wx.HORIZONTAL)
+        check = wx.CheckBox(self, -1,
+                            _(u"Convert downloaded .shn songs to FLAC?"))
+        if cfg.shn_to_flac:
+            check.SetValue(True)
+        self.Bind(wx.EVT_CHECKBOX, self.OnShnCheck, check)
+        tmpsizer.Add(check, 0)
+        sizer.Add(tmpsizer, 0, wx.ALL, 5)
+
         # preferred format
         tmpsizer = wx.BoxSizer(wx.HORIZONTAL)
         label = wx.StaticText(self, -1,
@@ -364,6 +446,21 @@ class ConfigurationDialog(wx.Dialog):
     def OnArtistCheck(self, event):
         cfg = lma.Config()
         cfg.artist_subdir = bool(event.GetInt())
+    def OnHarvestCheck(self, event):
+        cfg = lma.Config()
+        cfg.harvest_details = bool(event.GetInt())
+    def OnBackgroundCheck(self, event):
+        cfg = lma.Config()
+        cfg.background_download = bool(event.GetInt())
+    def OnSegmentedCheck(self, event):
+        cfg = lma.Config()
+        cfg.segmented_download = bool(event.GetInt())
+    def OnDedupCheck(self, event):
+        cfg = lma.Config()
+        cfg.dedup_store = bool(event.GetInt())
+    def OnShnCheck(self, event):
+        cfg = lma.Config()
+        cfg.shn_to_flac = bool(event.GetInt())
     def OnFormatChoice(self, event):
         cfg = lma.Config()
         cfg.preferred_format = event.GetString()
@@ -525,6 +622,7 @@ class ConcertListCtrl(wx.ListCtrl):
         super(ConcertListCtrl, self).__init__(parent, id, style=style)
         self._artist = None
         self.clist = None
+        self._prefetcher = lma.Prefetcher(lma.Config().dbpath())
 
         self.InsertColumn(0, _(u"Date"))
         self.InsertColumn(1, _(u"Concert Venue"))
@@ -544,6 +642,9 @@ class ConcertListCtrl(wx.ListCtrl):
         li.SetAlign(wx.LIST_FORMAT_CENTER)
         self.SetColumn(2, li)
 
+        # warm the details cache around the selected concert
+        self.Bind(wx.EVT_LIST_ITEM_SELECTED, self.OnSelected)
+
     def reset(self):
         if self.clist != None:
             self.SetItemCount(len(self.clist))
@@ -561,7 +662,8 @@ class ConcertListCtrl(wx.ListCtrl):
             self.reset()
     def download(self):
         if self.clist != None:
-            self.clist.repopulate(SingleProgressDialog)
+            self.clist.repopulate(SingleProgressDialog,
+                                  details=lma.Config().harvest_details)
             self.reset()
     def clearNew(self):
         if self.clist != None:
@@ -585,6 +687,19 @@ class ConcertListCtrl(wx.ListCtrl):
             if result == wx.ID_YES:
                 self.clist.forget()
                 self.reset()
+    def makeOffline(self):
+        """Fetch details for every concert, for offline browsing."""
+        if self.clist != None:
+            failed = self.clist.makeOffline(SingleProgressDialog)
+            if failed:
+                win = wx.MessageDialog(self,
+                                       _(u"Details for %d concerts could not "
+                                         u"be fetched.  Try again later to "
+                                         u"get the rest.") % failed,
+                                       _(u"Some details missing"),
+                                       style=wx.ICON_EXCLAMATION | wx.OK)
+                win.ShowModal()
+                win.Destroy()
     def getConcert(self, row):
         return self.clist[row]
     def lastUpdate(self):
@@ -599,6 +714,9 @@ class ConcertListCtrl(wx.ListCtrl):
         self.reset()
     def getArtistName(self):
         return self.clist.artistName
+    def stopPrefetch(self):
+        """Forget any pending background fetches."""
+        self._prefetcher.cancel()
     def toggleFavorite(self):
         self._artist.favorite = not self._artist.favorite
         if self._artist.favorite:
@@ -626,6 +744,15 @@ class ConcertListCtrl(wx.ListCtrl):
         elif column == 3:
             return self.clist[row].dldate
 
+    def OnSelected(self, event):
+        """Prefetch details for the selection, its neighbours, and the
+        rest of the visible rows."""
+        if self.clist != None:
+            self._prefetcher.requestAround(self.clist, event.GetIndex(),
+                                           self.GetTopItem(),
+                                           self.GetCountPerPage())
+        event.Skip()
+
 class ConcertListPanel(wx.Panel):
     """Panel for listing an artist's concerts.
 
@@ -715,6 +842,12 @@ class ConcertListPanel(wx.Panel):
         self._listctrl.forget()
         self.setUpdateText()
         self.setNewText()
+    def stopPrefetch(self):
+        self._listctrl.stopPrefetch()
+    def makeOffline(self):
+        self._listctrl.makeOffline()
+    def reset(self):
+        self._listctrl.reset()
 
     # method handlers
     def setConcertMode(self, event):
@@ -814,7 +947,7 @@ class ConcertSongListWindow(wx.ListCtrl):
         # move to top
         if self.GetItemCount() > 0:
             self.EnsureVisible(0)
-        self._flist = lma.ConcertFileList(concert)
+        self._flist = concert.fileList()
         self.reset()
 
     def OnGetItemText(self, row, column):
@@ -919,6 +1052,12 @@ class LMAFrame(wx.Frame):
         self.CreateStatusBar()
         self.SetStatusText("")
 
+        # keep an eye on the background downloads
+        self._dlstatus = None
+        self._timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnTimer, self._timer)
+        self._timer.Start(2000)
+
         # create menus
         menubar = wx.MenuBar()
 
@@ -931,6 +1070,17 @@ class LMAFrame(wx.Frame):
         self._fileMenu.Append(103, _(u"&Forget All"),
                               _(u"Remove all records"))
         self._fileMenu.Enable(103, False)
+        self._fileMenu.Append(104, _(u"Make &Offline"),
+                              _(u"Fetch details for all concerts"))
+        self._fileMenu.Enable(104, False)
+        self._fileMenu.Append(105, _(u"&Pause Downloads"),
+                              _(u"Pause background downloads"))
+        self._fileMenu.Append(106, _(u"&Resume Downloads"),
+                              _(u"Resume background downloads"))
+        self._fileMenu.Append(107, _(u"Scan &Library"),
+                              _(u"Find concerts already downloaded"))
+        self._fileMenu.Append(108, _(u"Scr&ub Library"),
+                              _(u"Check downloaded files for damage"))
         self._fileMenu.Append(wx.ID_EXIT, _(u"&Quit"), _(u"Exit program"))
         menubar.Append(self._fileMenu, _(u"&File"))
 
@@ -954,6 +1104,11 @@ class LMAFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.menuFetch, id=101)
         self.Bind(wx.EVT_MENU, self.menuClearNew, id=102)
         self.Bind(wx.EVT_MENU, self.menuForget, id=103)
+        self.Bind(wx.EVT_MENU, self.menuOffline, id=104)
+        self.Bind(wx.EVT_MENU, self.menuPause, id=105)
+        self.Bind(wx.EVT_MENU, self.menuResume, id=106)
+        self.Bind(wx.EVT_MENU, self.menuScan, id=107)
+        self.Bind(wx.EVT_MENU, self.menuScrub, id=108)
 
         self.Bind(wx.EVT_MENU, self.menuFavorite, id=201)
         self.Bind(wx.EVT_MENU, self.menuPreferences, id=202)
@@ -983,24 +1138,50 @@ class LMAFrame(wx.Frame):
             self._concert.setArtist(self._artist.getArtist(row))
             self.replacePanel(self._concert)
             self._fileMenu.Enable(103, True) # allow forgetting concerts
+            self._fileMenu.Enable(104, True) # allow fetching all details
             self._editMenu.Enable(201, True) # allow toggling favorites
         elif ID == CONCERT_LIST_ID:
             self._details.setConcert(self._concert.getConcert(row))
             self.replacePanel(self._details)
             self._fileMenu.Enable(102, False) # no new list to clear
             self._fileMenu.Enable(103, False) # can't (yet) forget songs
+            self._fileMenu.Enable(104, False) # already have the details
+
+    def OnTimer(self, event):
+        """Show how the background downloads (and processing) are going."""
+        status = wx.GetApp().downloads.status()
+        text = ""
+        if status:
+            left = [row for row in status if row[4] != lma.DL_DONE]
+            size = sum([row[2] for row in left])
+            done = sum([row[3] for row in left])
+            text = _(u"Downloads: %d songs left (%d%%)") % (
+                len(left), size and 100 * done // size)
+        jobs = [job for job in wx.GetApp().postprocess.status()
+                if job[2] in (lma.PP_QUEUED, lma.PP_ACTIVE)]
+        # (the finished ones have been counted out; let them go)
+        wx.GetApp().postprocess.clear()
+        if jobs:
+            text = (text and text + u"  ") + (
+                _(u"Processing: %d songs left") % len(jobs))
+        if text != self._dlstatus:
+            self.SetStatusText(text)
+            self._dlstatus = text
 
     def OnButton(self, event):
         """Method to handle various buttons."""
         ID = event.GetId()
         if ID == CONCERT_BACK_BUTTON_ID:
+            self._concert.stopPrefetch()
             self.replacePanel(self._artist)
             self._fileMenu.Enable(103, False) # no forgetting artists
+            self._fileMenu.Enable(104, False) # no fetching all details
             self._editMenu.Enable(201, False) # no toggling favorites
         elif ID == DETAILS_BACK_BUTTON_ID:
             self.replacePanel(self._concert)
             self._fileMenu.Enable(102, True) # allow clearing new-list
             self._fileMenu.Enable(103, True) # can forget concerts
+            self._fileMenu.Enable(104, True) # can fetch all details
 
     ## menu methods
 
@@ -1010,6 +1191,56 @@ class LMAFrame(wx.Frame):
         self._panel.clearNew()
     def menuForget(self, event):
         self._panel.forget()
+    def menuOffline(self, event):
+        self._panel.makeOffline()
+    def menuPause(self, event):
+        wx.GetApp().downloads.pause()
+    def menuResume(self, event):
+        wx.GetApp().downloads.resume()
+    def menuScan(self, event):
+        db = lma.ArDb(lma.Config().dbpath())
+        try:
+            (concerts, hashed) = lma.scan_library(
+                db, progbar=SingleProgressDialog)
+        finally:
+            db.close()
+        self._concert.reset()
+        self.SetStatusText(_(u"Library: %d concerts, %d files checked") %
+                           (concerts, hashed))
+    def menuScrub(self, event):
+        db = lma.ArDb(lma.Config().dbpath())
+        try:
+            report = lma.scrub_library(db, progbar=SingleProgressDialog,
+                                       store=download_store())
+            if report == None:
+                # cancelled; it'll pick up from there next time
+                return
+            bad = len(report["mismatched"]) + len(report["missing"])
+            text = (_(u"%d damaged, %d missing and %d extra files found.") %
+                    (len(report["mismatched"]), len(report["missing"]),
+                     len(report["extra"])))
+            if bad == 0:
+                win = wx.MessageDialog(self, text, _(u"Library checked"),
+                                       style=wx.ICON_INFORMATION | wx.OK)
+                win.ShowModal()
+                win.Destroy()
+                return
+            win = wx.MessageDialog(self, text + u"  " +
+                                   _(u"Download the damaged and missing "
+                                     u"files again?"),
+                                   _(u"Library checked"),
+                                   style=wx.ICON_EXCLAMATION | wx.YES_NO)
+            result = win.ShowModal()
+            win.Destroy()
+            if result == wx.ID_YES:
+                # (with the current settings, as for DownloadDialog)
+                downloads = wx.GetApp().downloads
+                downloads.segments = download_segments()
+                downloads.store = download_store()
+                wx.GetApp().postprocess.names = lma.configured_processors()
+                lma.requeue_damaged(db, report, downloads)
+        finally:
+            db.close()
     def menuQuit(self, event):
         self.Close()
 
@@ -1050,9 +1281,20 @@ class LMAFrame(wx.Frame):
 class LMAApp(wx.App):
     def OnInit(self):
         self.SetAppName("LlamaBrowser")
+        self.postprocess = lma.Pipeline()
+        # picks up anything left in the queue from last time
+        self.downloads = lma.DownloadManager(lma.Config().dbpath(),
+                                             segments=download_segments(),
+                                             store=download_store(),
+                                             post=self.postprocess)
         win = LMAFrame(None, -1, _(u"LlamaBrowser"))
         win.Show()
         return True
+    def OnExit(self):
+        self.downloads.stop()
+        # (don't hold up the exit for conversions still going)
+        self.postprocess.close(wait=False)
+        return 0
 
 def main():
     lma.Config("~/.llama", create=True)